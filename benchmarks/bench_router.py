@@ -0,0 +1,95 @@
+"""
+Measures how fast Replayer resolves requests to map keys, against the
+previous resolution that generated the key string on every request.
+
+    python benchmarks/bench_router.py [--keys N] [--requests N]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from collections import defaultdict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from mockasite.Replayer import Replayer
+from mockasite.utils import generate_map_key
+
+ORIGINS = ["no_origin", "https://example.com"]
+
+class LegacyResolver:
+    """Map key resolution as it was before the route table and key cache."""
+
+    def __init__(self, url_to_folder_map: dict):
+        self.url_to_folder_map = url_to_folder_map
+        self.request_count = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def resolve_map_key(self, http_method, path, query_params, origin_header):
+        query_params = list(query_params)
+        map_key = generate_map_key(http_method, path, query_params,
+                                   origin_header)
+        map_key_seq = map_key
+        with self.lock:
+            if self.request_count[map_key] > 0:
+                map_key_seq = generate_map_key(http_method, path,
+                                               query_params, origin_header,
+                                               self.request_count[map_key])
+            self.request_count[map_key] += 1
+            if map_key_seq in self.url_to_folder_map:
+                map_key = map_key_seq
+            else:
+                self.request_count[map_key] = 0
+        return map_key, map_key_seq
+
+def build_requests(keys: int, requests: int, rng: random.Random) -> list:
+    routes = [("GET", f"/assets/{i}/file{i}.js", ["v", "lang"][:i % 3],
+               ORIGINS[i % 2]) for i in range(keys)]
+    return [rng.choice(routes) for _ in range(requests)]
+
+def write_map(base_dir: Path, requests: list) -> dict:
+    url_to_folder_map = {}
+    for http_method, path, query_params, origin_header in set(
+        (m, p, tuple(q), o) for m, p, q, o in requests):
+        key = generate_map_key(http_method, path, query_params, origin_header)
+        url_to_folder_map[key] = ["META.json", "BODY"]
+        # Every fourth route was recorded more than once.
+        if len(path) % 4 == 0:
+            url_to_folder_map[f"{key}|1"] = ["META.json", "BODY"]
+    with open(base_dir / "url_to_folder_map.json", 'w',
+              encoding='utf-8') as f:
+        json.dump(url_to_folder_map, f)
+    return url_to_folder_map
+
+def run(resolve, requests: list) -> float:
+    started = time.perf_counter()
+    for http_method, path, query_params, origin_header in requests:
+        resolve(http_method, path, query_params, origin_header)
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--keys', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    requests = build_requests(args.keys, args.requests, random.Random(1))
+    with tempfile.TemporaryDirectory() as tmp:
+        url_to_folder_map = write_map(Path(tmp), requests)
+        replayer = Replayer(Path(tmp) / "url_to_folder_map.json",
+                            "https://example.com/")
+        legacy = LegacyResolver(url_to_folder_map)
+
+        for name, resolve in (("legacy", legacy.resolve_map_key),
+                              ("replayer", replayer.resolve_map_key)):
+            best = min(run(resolve, requests) for _ in range(args.repeat))
+            print(f"{name:<10} {best * 1e9 / len(requests):8.0f} ns/request")
+
+if __name__ == "__main__":
+    main()
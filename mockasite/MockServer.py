@@ -1,51 +1,44 @@
-import json
-import os
-from collections import defaultdict
+import time
 from pathlib import Path
-from flask import Flask, request, Response, redirect
+from flask import Flask, request, Response
 from flask_cors import CORS
-from .utils import (get_pkg_name, generate_map_key, split_map_key)
+from werkzeug.serving import WSGIRequestHandler
+from .Replayer import Replayer, StreamedBody
+from .shaping import Shaper
+from .access_log import AccessLog
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Requests are logged by the Replayer's access log instead."""
+
+    def log_request(self, code="-", size="-"):
+        pass
 
 class MockServer:
     RED = '\033[91m'
     GREEN = '\033[92m'
     RESET = '\033[0m'
 
-    def __init__(self, url_to_folder_map_file: Path, port: int, entry_url: str):
+    # The proxy applies this delay so no Flask worker sleeps on it.
+    DELAY_HEADER = 'X-Mockasite-Delay'
+    # Tells the proxy to pass the body on as it arrives instead of buffering.
+    STREAM_HEADER = 'X-Mockasite-Stream'
+    # Set by the proxy, which rewrites the Host to reach this server.
+    HOST_HEADER = 'X-Mockasite-Host'
+
+    def __init__(self, url_to_folder_map_file: Path, port: int, entry_url: str,
+                 shaper: Shaper = None, access_log: AccessLog = None,
+                 replayer=None):
+        """
+        replayer replaces the Replayer built from url_to_folder_map_file, e.g.
+        with a SiteRouter serving several sites.
+        """
         self.app = Flask(__name__)
         self.port = port
         self.entry_url = entry_url
         CORS(self.app)
 
-        self.request_count = defaultdict(int)
-        self.url_to_folder_map_file = url_to_folder_map_file
-
-        self.base_dir = self.url_to_folder_map_file.parent
-
-        with open(self.url_to_folder_map_file, 'r', encoding='utf-8') as f:
-            raw_map = json.load(f)
-
-
-        self.url_to_folder_map = {}
-
-        for key, value in raw_map.items():
-            if value is None:
-                self.url_to_folder_map[key] = None
-                continue
-            meta, body = value
-
-            meta_path = Path(meta)
-            body_path = Path(body)
-
-            if not meta_path.is_absolute():
-                meta_path = self.base_dir / meta_path
-
-            if not body_path.is_absolute():
-                body_path = self.base_dir / body_path
-
-            self.url_to_folder_map[key] = [str(meta_path), str(body_path)]
-
-        self.ignore_headers = {'content-encoding', 'content-length'}
+        self.replayer = replayer or Replayer(url_to_folder_map_file,
+                                             entry_url, shaper, access_log)
 
         self.app.add_url_rule('/', view_func=self.root_redirect, methods=['GET'])
 
@@ -54,80 +47,42 @@ class MockServer:
                                 'OPTIONS'])(self.mock_server)
 
     def root_redirect(self):
-        return redirect(self.entry_url, code=302)
+        # The replayer knows the entry URL of the site the host belongs to.
+        return self.mock_server('')
 
     def mock_server(self, path):
         http_method = request.method
         origin_header = request.headers.get("Origin", "no_origin")
         query_params = request.args.keys()
-        map_key = generate_map_key(http_method, '/' + path, query_params, origin_header)
-        map_key_seq = map_key
-        _, _, query_param_hash, _, _ = split_map_key(map_key)
-
-        if self.request_count[map_key] > 0:
-            map_key_seq = generate_map_key(http_method, '/' + path,
-                                           query_params,
-                                           origin_header,
-                                           self.request_count[map_key])
 
-        self.request_count[map_key] += 1
+        status_code, headers, body, delay = self.replayer.replay(
+            http_method, '/' + path, query_params, origin_header,
+            request.get_data(), request.content_type,
+            request.headers.get(self.HOST_HEADER) or request.host)
 
-        if map_key_seq in self.url_to_folder_map:
-            map_key = map_key_seq
+        if isinstance(body, StreamedBody):
+            response = Response(self.stream_body(body), status=status_code)
+            response.headers[self.STREAM_HEADER] = "1"
         else:
-            self.request_count[map_key] = 0
-
-        if map_key in self.url_to_folder_map and self.url_to_folder_map[
-                map_key] is not None:
-
-            meta_path, body_path = self.url_to_folder_map[map_key]
-
-            meta = {"status_code": 200, "headers": {}}
-            body = b''
-
-            if os.path.isfile(meta_path):
-                with open(meta_path, 'r', encoding='utf-8') as f:
-                    meta = json.load(f)
+            response = Response(body, status=status_code)
 
-            if os.path.isfile(body_path):
-                with open(body_path, 'rb') as f:
-                    body = f.read()
+        for key, value in headers.items():
+            response.headers[key] = value
 
-            status_code = meta["status_code"]
+        if delay > 0:
+            response.headers[self.DELAY_HEADER] = f"{delay:.6f}"
 
-            response = Response(body, status=status_code)
-
-            for key, value in meta["headers"].items():
-                if key in self.ignore_headers: continue
-                response.headers[key] = value
-
-
-            print(f"DEBUG: body_path: {body_path}", flush=True)
-            return response
-
-        # Debug information if map_key was not found
-        debug_info = {
-            "source": f"{get_pkg_name()}",
-            "message": "No recorded response found for request.",
-            "http_method": http_method,
-            "path": path,
-            "entry_url": self.entry_url,
-            "origin_header": origin_header,
-            "query_params": list(query_params),
-            "query_param_hash": query_param_hash,
-            "generated_map_key": map_key,
-            "map_key_sequence": map_key_seq,
-            "available_keys": list(self.url_to_folder_map.keys())
-        }
-
-        # Return debug info as a JSON response
-        response = Response(json.dumps(debug_info, indent=4), status=404, mimetype="application/json")
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        if origin_header:
-            response.headers['Access-Control-Allow-Origin'] = origin_header
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
-        response.headers['Vary'] = 'Origin'
         return response
 
+    @staticmethod
+    def stream_body(body: StreamedBody):
+        for delay, data in body:
+            if delay > 0:
+                time.sleep(delay)
+            yield data
+
     def run(self):
-        self.app.run(port=self.port, debug=True, use_reloader=False)
+        self.app.run(port=self.port,
+                     debug=True,
+                     use_reloader=False,
+                     request_handler=QuietRequestHandler)
@@ -0,0 +1,377 @@
+import json
+import errno
+import time
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Iterator, Tuple, Dict, Optional, Union
+from .utils import (get_pkg_name, get_cached_map_key, split_map_key,
+                    get_base_map_key, body_fingerprint, get_processed_hosts,
+                    BODY_FINGERPRINT_INDEX_FILE)
+from .shaping import Shaper
+from .access_log import AccessLog
+from .body_cache import BodyCache
+
+# Largest piece of a streamed body held in memory at once.
+STREAM_READ_SIZE = 64 * 1024
+
+class StreamedBody:
+    """
+    Body of a response that was recorded as a stream. Iterating yields
+    (delay, data) pairs read from the BODY file one chunk at a time, so only
+    a single chunk per connection is in memory.
+    """
+
+    def __init__(self, body_path, chunks: list, shaper: Shaper):
+        self.body_path = body_path
+        self.chunks = chunks
+        self.shaper = shaper
+
+    def __len__(self) -> int:
+        return sum(size for size, _ in self.chunks)
+
+    def __iter__(self) -> Iterator[Tuple[float, bytes]]:
+        if not self.body_path.is_file():
+            return
+
+        with self.body_path.open('rb') as f:
+            for size, gap in self.chunks:
+                delay = self.shaper.chunk_delay(gap, size)
+                while size > 0:
+                    data = f.read(min(size, STREAM_READ_SIZE))
+                    if not data: return
+                    yield delay, data
+                    delay = 0.0
+                    size -= len(data)
+
+    def read(self) -> bytes:
+        """The whole body, for transports that cannot stream."""
+        return b''.join(data for _, data in self)
+
+class Replayer:
+    """
+    Resolves incoming requests against a processed url_to_folder_map.
+
+    This holds no web framework state so the same lookup can be driven by the
+    Flask MockServer, a mitmproxy addon or the standalone zipapp server.
+    """
+
+    CORS_ALLOW_METHODS = "DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
+
+    def __init__(self,
+                 url_to_folder_map_file,
+                 entry_url: str,
+                 shaper: Optional[Shaper] = None,
+                 access_log: Optional[AccessLog] = None,
+                 body_cache: Optional[BodyCache] = None):
+        """
+        url_to_folder_map_file may be a pathlib.Path or a zipfile.Path; all
+        recorded files are resolved relative to its parent.
+        """
+        self.entry_url = entry_url
+        self.shaper = shaper or Shaper()
+        self.access_log = access_log or AccessLog(level="off")
+        self.body_cache = body_cache
+        self.url_to_folder_map_file = url_to_folder_map_file
+        self.base_dir = self.url_to_folder_map_file.parent
+
+        self.request_count = defaultdict(int)
+        self.tier_count = defaultdict(int)
+        self.lock = threading.Lock()
+
+        with self.url_to_folder_map_file.open('r', encoding='utf-8') as f:
+            raw_map = json.load(f)
+
+        self.hosts = get_processed_hosts(raw_map)
+        self.url_to_folder_map = {}
+        # (base map key, sequence number) -> recorded map key, where the
+        # first recorded response has sequence number 0.
+        self.routes: Dict[Tuple[str, int], str] = {}
+
+        for key, value in raw_map.items():
+            sequence_number = split_map_key(key)[4]
+            self.routes[(get_base_map_key(key),
+                         int(sequence_number or 0))] = key
+            if value is None:
+                self.url_to_folder_map[key] = None
+                continue
+            meta, body = value
+            self.url_to_folder_map[key] = [
+                self.resolve_path(meta),
+                self.resolve_path(body)
+            ]
+
+        self.load_fingerprint_index()
+
+        self.ignore_headers = {
+            'content-encoding', 'content-length', 'transfer-encoding'
+        }
+
+    def load_fingerprint_index(self):
+        """
+        Loads the request body fingerprints written by --process into a dict
+        keyed by (map_key, fingerprint).
+        """
+        self.ignore_body_fields = []
+        self.fingerprint_index = {}
+        self.fingerprint_count = defaultdict(int)
+
+        index_file = self.base_dir / BODY_FINGERPRINT_INDEX_FILE
+        if not index_file.is_file():
+            return
+
+        with index_file.open('r', encoding='utf-8') as f:
+            index = json.load(f)
+
+        self.ignore_body_fields = index.get("ignore_fields", [])
+        for map_key, entries in index.get("keys", {}).items():
+            for fingerprint, map_keys in entries.items():
+                self.fingerprint_index[(map_key, fingerprint)] = map_keys
+
+    def resolve_path(self, recorded_path: str):
+        if isinstance(self.base_dir,
+                      Path) and Path(recorded_path).is_absolute():
+            return Path(recorded_path)
+        return self.base_dir / recorded_path
+
+    def resolve_map_key(self,
+                        http_method: str,
+                        path: str,
+                        query_params: Iterable[str],
+                        origin_header: str,
+                        body: bytes = b'',
+                        content_type: Optional[str] = None
+                        ) -> Tuple[str, str, str]:
+        """
+        Returns the map key to serve, the sequenced key that was tried and
+        the tier that resolved it (fingerprint, sequence or key). Requests
+        whose body fingerprint was recorded are answered with the responses
+        recorded for that body, in order; all others advance the per-key
+        request counter.
+        """
+        map_key = get_cached_map_key(http_method, path, tuple(query_params),
+                                     origin_header)
+
+        if self.fingerprint_index and body:
+            fingerprint = body_fingerprint(body, content_type,
+                                           self.ignore_body_fields)
+            map_keys = self.fingerprint_index.get((map_key, fingerprint))
+            if map_keys:
+                with self.lock:
+                    count = self.fingerprint_count[(map_key, fingerprint)]
+                    self.fingerprint_count[(map_key, fingerprint)] += 1
+                map_key_seq = map_keys[count % len(map_keys)]
+                return map_key_seq, map_key_seq, "fingerprint"
+
+        with self.lock:
+            count = self.request_count[map_key]
+            self.request_count[map_key] = count + 1
+            recorded_key = self.routes.get((map_key, count))
+            if recorded_key is None:
+                self.request_count[map_key] = 0
+
+        if recorded_key is not None:
+            return recorded_key, recorded_key, "sequence" if count else "key"
+        return map_key, f"{map_key}|{count}" if count else map_key, "key"
+
+    def replay(
+        self,
+        http_method: str,
+        path: str,
+        query_params: Iterable[str],
+        origin_header: str,
+        request_body: bytes = b'',
+        content_type: Optional[str] = None,
+        host: Optional[str] = None
+    ) -> Tuple[int, Dict[str, str], Union[bytes, StreamedBody], float]:
+        """
+        Returns (status_code, headers, body, delay) for a request. delay is
+        the number of seconds the transport should wait before answering, as
+        decided by the shaper; transports must not block a worker on it.
+        body is a StreamedBody for responses that were recorded as streams.
+        A Replayer serves one site for every host; host is only used by the
+        SiteRouter.
+        """
+        started = time.perf_counter()
+        query_params = list(query_params)
+
+        if http_method == 'GET' and path == '/':
+            self.log_access("info", f"{http_method}|{path}", "redirect", 302,
+                            0, started)
+            return 302, {"Location": self.entry_url}, b'', 0.0
+
+        map_key, map_key_seq, tier = self.resolve_map_key(
+            http_method, path, query_params, origin_header, request_body,
+            content_type)
+
+        if self.url_to_folder_map.get(map_key) is not None:
+            meta_path, body_path = self.url_to_folder_map[map_key]
+            try:
+                status_code, headers, body, timing = self.load_response(
+                    meta_path, body_path)
+            except FileNotFoundError as e:
+                status_code, headers, body = self.missing_file(
+                    map_key, e.filename)
+                self.log_access("warning", map_key, "missing", status_code,
+                                len(body), started)
+                return status_code, headers, body, 0.0
+            if isinstance(body, StreamedBody):
+                # The transfer time is spread over the chunk gaps instead.
+                timing = dict(timing or {}, duration=0.0, size=0)
+            delay = self.shaper.delay(timing, len(body))
+            self.log_access("info", map_key, tier, status_code, len(body),
+                            started, delay, body_path)
+            return status_code, headers, body, delay
+
+        status_code, headers, body = self.not_found(http_method, path,
+                                                    query_params,
+                                                    origin_header, map_key,
+                                                    map_key_seq)
+        self.log_access("warning", map_key_seq, "miss", status_code,
+                        len(body), started)
+        return status_code, headers, body, 0.0
+
+    def log_access(self,
+                   level: str,
+                   map_key: str,
+                   tier: str,
+                   status_code: int,
+                   size: int,
+                   started: float,
+                   delay: float = 0.0,
+                   body_path=None):
+        """latency is the time spent resolving and loading, in ms."""
+        with self.lock:
+            self.tier_count[tier] += 1
+        if not self.access_log.is_enabled_for(level):
+            return
+        fields = {
+            "key": map_key,
+            "tier": tier,
+            "status": status_code,
+            "bytes": size,
+            "latency": round((time.perf_counter() - started) * 1000, 3)
+        }
+        if delay:
+            fields["delay"] = round(delay, 3)
+        if body_path is not None and self.access_log.is_enabled_for("debug"):
+            fields["body_path"] = str(body_path)
+        self.access_log.log(level, **fields)
+
+    def load_response(
+        self, meta_path, body_path
+    ) -> Tuple[int, Dict[str, str], Union[bytes, StreamedBody], Optional[dict]]:
+        """
+        Raises FileNotFoundError when a recorded file is missing, rather
+        than answering with an empty body.
+        """
+        for recorded_path in (meta_path, body_path):
+            if not recorded_path.is_file():
+                raise FileNotFoundError(errno.ENOENT,
+                                        "Recorded file is missing",
+                                        str(recorded_path))
+
+        with meta_path.open('r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        if meta.get("chunks"):
+            body = StreamedBody(body_path, meta["chunks"], self.shaper)
+        elif self.body_cache is not None and meta.get("body_sha256"):
+            body = self.body_cache.get(meta["body_sha256"],
+                                       lambda: self.read_body(body_path))
+        else:
+            body = self.read_body(body_path)
+
+        headers = {
+            key: value
+            for key, value in meta["headers"].items()
+            if key.lower() not in self.ignore_headers
+        }
+        return meta["status_code"], headers, body, meta.get("timing")
+
+    def reset(self):
+        """Starts every sequence over, as if playback was restarted."""
+        with self.lock:
+            self.request_count.clear()
+            self.fingerprint_count.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            tiers = dict(self.tier_count)
+        stats = {
+            "requests": sum(tiers.values()),
+            "tiers": tiers,
+            "keys": len(self.url_to_folder_map)
+        }
+        if self.body_cache is not None:
+            stats["body_cache"] = self.body_cache.stats()
+        return stats
+
+    @staticmethod
+    def read_body(body_path) -> bytes:
+        with body_path.open('rb') as f:
+            return f.read()
+
+    def missing_file(self, map_key: str,
+                     recorded_path: str) -> Tuple[int, Dict[str, str], bytes]:
+        debug_info = {
+            "source": f"{get_pkg_name()}",
+            "message": "A recorded file is missing. Run --verify to check" +
+            " the processed files.",
+            "map_key": map_key,
+            "missing_file": recorded_path
+        }
+        headers = {"Content-Type": "application/json"}
+        return 500, headers, json.dumps(debug_info, indent=4).encode()
+
+    def not_found(self, http_method: str, path: str, query_params: list,
+                  origin_header: str, map_key: str,
+                  map_key_seq: str) -> Tuple[int, Dict[str, str], bytes]:
+        _, _, query_param_hash, _, _ = split_map_key(map_key)
+
+        # Debug information if map_key was not found
+        debug_info = {
+            "source": f"{get_pkg_name()}",
+            "message": "No recorded response found for request.",
+            "http_method": http_method,
+            "path": path.lstrip('/'),
+            "entry_url": self.entry_url,
+            "origin_header": origin_header,
+            "query_params": query_params,
+            "query_param_hash": query_param_hash,
+            "generated_map_key": map_key,
+            "map_key_sequence": map_key_seq,
+            "available_keys": list(self.url_to_folder_map.keys())
+        }
+
+        headers = {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": origin_header or '*',
+            "Access-Control-Allow-Credentials": "true",
+            "Vary": "Origin"
+        }
+        return 404, headers, json.dumps(debug_info, indent=4).encode()
+
+    def add_cors_headers(self, headers: Dict[str, str], http_method: str,
+                         request_headers) -> Dict[str, str]:
+        """
+        Mirrors the defaults flask-cors applies to MockServer responses, for
+        transports that do not go through Flask.
+        """
+        origin: Optional[str] = request_headers.get("Origin")
+        if not origin:
+            return headers
+        if any(k.lower() == 'access-control-allow-origin' for k in headers):
+            return headers
+
+        headers["Access-Control-Allow-Origin"] = origin
+        headers["Vary"] = "Origin"
+
+        request_method = request_headers.get("Access-Control-Request-Method")
+        if http_method == 'OPTIONS' and request_method:
+            headers["Access-Control-Allow-Methods"] = self.CORS_ALLOW_METHODS
+            request_headers_list = request_headers.get(
+                "Access-Control-Request-Headers")
+            if request_headers_list:
+                headers["Access-Control-Allow-Headers"] = request_headers_list
+        return headers
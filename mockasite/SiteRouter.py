@@ -0,0 +1,91 @@
+import json
+from urllib.parse import urlparse
+from typing import Iterable, Tuple, Dict, Optional, List
+from .Replayer import Replayer
+from .shaping import Shaper
+from .access_log import AccessLog
+from .body_cache import BodyCache
+from .utils import get_pkg_name
+
+class SiteRouter:
+    """
+    Serves several processed sites from one process by routing each request
+    to the Replayer of the site that recorded its host. All Replayers share
+    one shaper, access log and body cache.
+
+    When more than one site recorded a host, the site listed first wins.
+    """
+
+    def __init__(self,
+                 sites: List[Tuple[str, object, str]],
+                 shaper: Optional[Shaper] = None,
+                 access_log: Optional[AccessLog] = None,
+                 body_cache: Optional[BodyCache] = None):
+        """sites is a list of (name, url_to_folder_map_file, entry_url)."""
+        self.replayers: Dict[str, Replayer] = {}
+        self.hosts: Dict[str, Replayer] = {}
+
+        for name, url_to_folder_map_file, entry_url in sites:
+            replayer = Replayer(url_to_folder_map_file, entry_url, shaper,
+                                access_log, body_cache)
+            self.replayers[name] = replayer
+            for host in replayer.hosts:
+                self.hosts.setdefault(host, replayer)
+
+        if not self.replayers:
+            raise ValueError("No sites to serve.")
+        self.default = next(iter(self.replayers.values()))
+
+    def get_replayer(self, host: Optional[str]) -> Optional[Replayer]:
+        """Requests that carry no host go to the first site."""
+        if not host:
+            return self.default
+        return self.hosts.get(urlparse(f"//{host}").hostname or host)
+
+    def replay(self,
+               http_method: str,
+               path: str,
+               query_params: Iterable[str],
+               origin_header: str,
+               request_body: bytes = b'',
+               content_type: Optional[str] = None,
+               host: Optional[str] = None):
+        """Same contract as Replayer.replay, routed by host."""
+        replayer = self.get_replayer(host)
+        if replayer is None:
+            return self.unknown_host(host) + (0.0, )
+        return replayer.replay(http_method, path, query_params, origin_header,
+                               request_body, content_type)
+
+    def unknown_host(self, host: str) -> Tuple[int, Dict[str, str], bytes]:
+        debug_info = {
+            "source": f"{get_pkg_name()}",
+            "message": "No loaded site recorded this host.",
+            "host": host,
+            "sites": list(self.replayers),
+            "hosts": sorted(self.hosts)
+        }
+        headers = {"Content-Type": "application/json"}
+        return 404, headers, json.dumps(debug_info, indent=4).encode()
+
+    def reset(self):
+        for replayer in self.replayers.values():
+            replayer.reset()
+
+    def stats(self) -> dict:
+        sites = {
+            name: replayer.stats()
+            for name, replayer in self.replayers.items()
+        }
+        stats = {
+            "requests": sum(site["requests"] for site in sites.values()),
+            "sites": sites
+        }
+        if self.default.body_cache is not None:
+            stats["body_cache"] = self.default.body_cache.stats()
+        return stats
+
+    def add_cors_headers(self, headers: Dict[str, str], http_method: str,
+                         request_headers) -> Dict[str, str]:
+        return self.default.add_cors_headers(headers, http_method,
+                                             request_headers)
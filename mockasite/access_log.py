@@ -0,0 +1,127 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import threading
+from typing import Optional
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "off": 100}
+
+# Lines are written once this many are pending or FLUSH_INTERVAL passed.
+BATCH_SIZE = 256
+FLUSH_INTERVAL = 0.5
+
+# Entries beyond this many pending ones are dropped instead of blocking.
+MAX_PENDING = 10_000
+
+class AccessLog:
+    """
+    Structured playback access log. log() only formats a dict and queues it;
+    a background thread writes the JSON lines in batches, so requests never
+    wait on the terminal or the disk.
+
+    Hits are logged at info, misses at warning, and debug adds the recorded
+    file paths. sample is the fraction of info and debug entries that are
+    kept; warnings are never sampled out.
+    """
+
+    def __init__(self,
+                 path: str = "-",
+                 level: str = "info",
+                 sample: float = 1.0,
+                 batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL):
+        if level not in LOG_LEVELS:
+            raise ValueError(f"Unknown log level '{level}'. Choose one of:" +
+                             f" {', '.join(LOG_LEVELS)}.")
+        if not 0.0 <= sample <= 1.0:
+            raise ValueError("The log sample rate must be between 0 and 1.")
+
+        self.path = path
+        self.level = LOG_LEVELS[level]
+        self.sample = sample
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(MAX_PENDING)
+        self.dropped = 0
+        self.stopping = False
+        self.thread: Optional[threading.Thread] = None
+
+        if self.level < LOG_LEVELS["off"]:
+            self.thread = threading.Thread(target=self.run,
+                                           name="access-log",
+                                           daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def is_enabled_for(self, level: str) -> bool:
+        return LOG_LEVELS[level] >= self.level
+
+    def log(self, level: str, **fields):
+        if not self.is_enabled_for(level):
+            return
+        if level != "warning" and self.sample < 1.0 and random.random(
+        ) >= self.sample:
+            return
+
+        fields = {"ts": round(time.time(), 3), "level": level, **fields}
+        try:
+            self.pending.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        # pylint: disable=consider-using-with
+        out = sys.stdout if self.path == "-" else open(
+            self.path, 'a', encoding='utf-8')
+        try:
+            while not self.stopping:
+                batch = self.next_batch()
+                if batch:
+                    self.write(out, batch)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def next_batch(self) -> list:
+        """
+        Collects up to batch_size entries, waiting at most flush_interval
+        after the first one. Stops early once close() was called.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            timeout = None if deadline is None else max(
+                deadline - time.monotonic(), 0.0)
+            try:
+                entry = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is None:
+                self.stopping = True
+                break
+            batch.append(entry)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch
+
+    def write(self, out, batch: list):
+        if self.dropped:
+            batch.append({
+                "ts": round(time.time(), 3),
+                "level": "warning",
+                "dropped": self.dropped
+            })
+            self.dropped = 0
+        out.write(''.join(json.dumps(entry) + '\n' for entry in batch))
+        out.flush()
+
+    def close(self):
+        """Writes what is still pending and stops the writer thread."""
+        if self.thread is None:
+            return
+        self.pending.put(None)
+        self.thread.join(timeout=5)
+        self.thread = None
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+# Bodies larger than this are always read from disk.
+MAX_CACHED_BODY_SIZE = 8 * 1024 * 1024
+
+class BodyCache:
+    """
+    Least recently used cache of response bodies keyed by their sha256. The
+    key is the content, not the file, so identical bodies recorded by several
+    sites (shared libraries, fonts, images) are held in memory once.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.bodies: "OrderedDict[str, bytes]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest: str, load: Callable[[], bytes]) -> bytes:
+        """Returns the cached body for digest, calling load() on a miss."""
+        with self.lock:
+            body: Optional[bytes] = self.bodies.get(digest)
+            if body is not None:
+                self.bodies.move_to_end(digest)
+                self.hits += 1
+                return body
+            self.misses += 1
+
+        body = load()
+        if len(body) <= min(self.max_bytes, MAX_CACHED_BODY_SIZE):
+            self.put(digest, body)
+        return body
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.bodies),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def put(self, digest: str, body: bytes):
+        with self.lock:
+            if digest in self.bodies:
+                return
+            self.bodies[digest] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.bodies.popitem(last=False)
+                self.size -= len(evicted)
@@ -0,0 +1,105 @@
+import os
+import errno
+import hashlib
+import shutil
+from pathlib import Path
+
+# Stored bodies are shared by every tree that links them.
+BODY_MODE = 0o444
+
+class BodyStore:
+    """
+    Content addressed store of processed response bodies, shared by every
+    site and capture. Bodies are kept once under their sha256 and hardlinked
+    into the www trees, so reprocessing a capture whose bodies did not change
+    writes no body data at all.
+
+    A body whose only link is the one in the store is not used by any www
+    tree anymore and is removed by prune(). Stored bodies are read-only, so
+    anything that writes into a linked file in place fails instead of
+    changing the body for every tree; replace files, never rewrite them.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.added = 0
+        self.added_bytes = 0
+        self.reused = 0
+        self.reused_bytes = 0
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def store(self, tmp_path: str, digest: str, dest_path: str):
+        """
+        Moves the freshly written body at tmp_path into the store, or drops
+        it when the store already has that digest, and links it to
+        dest_path.
+        """
+        blob_path = self.path(digest)
+        size = os.path.getsize(tmp_path)
+        if blob_path.exists():
+            os.remove(tmp_path)
+            self.reused += 1
+            self.reused_bytes += size
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            os.chmod(tmp_path, BODY_MODE)
+            os.replace(tmp_path, blob_path)
+            self.added += 1
+            self.added_bytes += size
+
+        self.link(digest, dest_path)
+
+    def reuse(self, digest: str, dest_path: str) -> bool:
+        """
+        Links the stored body with this digest to dest_path if the store has
+        it. Returns False, without touching dest_path, if it does not.
+        """
+        blob_path = self.path(digest)
+        if not blob_path.exists():
+            return False
+        self.link(digest, dest_path)
+        self.reused += 1
+        self.reused_bytes += blob_path.stat().st_size
+        return True
+
+    def put(self, data: bytes) -> str:
+        """Adds data to the store unless present and returns its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.path(digest)
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = blob_path.with_name(f"{digest}.{os.getpid()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, BODY_MODE)
+            os.replace(tmp_path, blob_path)
+            self.added += 1
+            self.added_bytes += len(data)
+        return digest
+
+    def link(self, digest: str, dest_path: str):
+        """Makes dest_path the stored body with this digest."""
+        blob_path = self.path(digest)
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(blob_path, dest_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            # Different file system or no hardlink support: keep a copy.
+            shutil.copyfile(blob_path, dest_path)
+
+    def prune(self) -> int:
+        """Removes the bodies no www tree links to. Returns their count."""
+        removed = 0
+        if not self.root.exists():
+            return removed
+        for blob_dir in self.root.iterdir():
+            for blob_path in blob_dir.iterdir():
+                if blob_path.stat().st_nlink == 1:
+                    blob_path.unlink()
+                    removed += 1
+        return removed
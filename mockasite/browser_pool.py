@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import fcntl
+import base64
+import socket
+import struct
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import List, Optional, Tuple
+from .utils import find_free_port
+
+POOL_STATE_FILE = "browser_pool.json"
+
+# Seconds to wait for a new instance to answer on its DevTools port.
+DEVTOOLS_TIMEOUT = 30
+
+LEASE_FILE = "lease.lock"
+
+class BrowserInstance:
+    """
+    One headless Chrome with its own user data dir, DevTools port and the
+    proxy port it sends all traffic to. The proxy does not have to run while
+    the browser waits; capture or playback starts it on proxy_port when the
+    instance is leased.
+    """
+
+    def __init__(self, instance_id: int, user_data_dir: Path,
+                 devtools_port: int, proxy_port: int):
+        self.instance_id = instance_id
+        self.user_data_dir = user_data_dir
+        self.devtools_port = devtools_port
+        self.proxy_port = proxy_port
+        self.process: Optional[subprocess.Popen] = None
+        self.websocket_url: Optional[str] = None
+
+    def command(self, chrome: str) -> List[str]:
+        return [
+            chrome, "--headless=new", f"--user-data-dir={self.user_data_dir}",
+            f"--remote-debugging-port={self.devtools_port}",
+            f"--proxy-server=http://127.0.0.1:{self.proxy_port}",
+            # Traffic only goes to our proxy, which signs with its own CA.
+            "--ignore-certificate-errors",
+            # Sessions browse in their own contexts (LeasedBrowser); the
+            # default profile should not keep a cache either.
+            "--disk-cache-size=1", "--media-cache-size=1",
+            "--no-first-run", "--no-default-browser-check", "about:blank"
+        ]
+
+    def start(self, chrome: str):
+        self.user_data_dir.mkdir(parents=True, exist_ok=True)
+        # pylint: disable=consider-using-with
+        self.process = subprocess.Popen(self.command(chrome),
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL,
+                                        start_new_session=True)
+
+    def wait_ready(self, timeout: float = DEVTOOLS_TIMEOUT) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.is_alive():
+                return False
+            try:
+                version = devtools_request(self.devtools_port, "version")
+                self.websocket_url = version.get("webSocketDebuggerUrl")
+                return True
+            except OSError:
+                time.sleep(0.1)
+        return False
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def to_state(self) -> dict:
+        return {
+            "id": self.instance_id,
+            "pid": self.process.pid if self.process else None,
+            "devtools_port": self.devtools_port,
+            "proxy_port": self.proxy_port,
+            "websocket_url": self.websocket_url,
+            "user_data_dir": str(self.user_data_dir)
+        }
+
+class BrowserPool:
+    """
+    Pre-launched headless Chrome instances that stay warm between runs.
+    Instances that exit are started again by watch().
+    """
+
+    def __init__(self, size: int, root: Path, chrome: str):
+        self.root = root
+        self.chrome = chrome
+        self.instances: List[BrowserInstance] = []
+
+        taken = set()
+        port = 9222
+        for instance_id in range(size):
+            ports = []
+            for _ in range(2):
+                port = find_free_port(starting_from=port)
+                while port in taken:
+                    port = find_free_port(starting_from=port + 1)
+                taken.add(port)
+                ports.append(port)
+            self.instances.append(
+                BrowserInstance(instance_id, root / str(instance_id),
+                                ports[0], ports[1]))
+
+    def start(self) -> List[BrowserInstance]:
+        """Starts all instances at once. Returns the ones that failed."""
+        for instance in self.instances:
+            instance.start(self.chrome)
+        return [i for i in self.instances if not i.wait_ready()]
+
+    def write_state(self, state_file: Path):
+        tmp_file = state_file.with_suffix(".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(
+                {
+                    "pid": os.getpid(),
+                    "instances": [i.to_state() for i in self.instances]
+                },
+                f,
+                indent=4)
+        os.replace(tmp_file, state_file)
+
+    def watch(self, state_file: Path, interval: float = 1.0):
+        """Restarts instances that exited until interrupted."""
+        while True:
+            time.sleep(interval)
+            restarted = False
+            for instance in self.instances:
+                if not instance.is_alive():
+                    print(f"Restart browser {instance.instance_id}.")
+                    instance.start(self.chrome)
+                    instance.wait_ready()
+                    restarted = True
+            if restarted:
+                self.write_state(state_file)
+
+    def stop(self):
+        for instance in self.instances:
+            instance.stop()
+
+def devtools_request(port: int, endpoint: str, method: str = "GET"):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/json/{endpoint}", method=method)
+    with urllib.request.urlopen(request, timeout=2) as response:
+        body = response.read()
+    try:
+        return json.loads(body)
+    except ValueError:
+        return body.decode(errors="replace")
+
+def read_pool_state(state_file: Path) -> Optional[dict]:
+    """Returns the state of a running pool, or None."""
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        os.kill(state["pid"], 0)
+    except (FileNotFoundError, ValueError, ProcessLookupError):
+        return None
+    except PermissionError:
+        pass
+    return state
+
+def lease_instance(state_file: Path) -> Optional[Tuple[dict, object]]:
+    """
+    Takes a free instance of the running pool. The lease is a lock on the
+    instance's lease file, held by the returned file object until it is
+    closed or the process exits, so crashed sessions never leak instances.
+    """
+    state = read_pool_state(state_file)
+    if state is None:
+        return None
+
+    for instance in state["instances"]:
+        lease_path = Path(instance["user_data_dir"]) / LEASE_FILE
+        # pylint: disable=consider-using-with
+        lease = open(lease_path, 'a', encoding='utf-8')
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lease.close()
+            continue
+        return instance, lease
+    return None
+
+class DevToolsError(Exception):
+    pass
+
+class DevToolsConnection:
+    """
+    Minimal DevTools protocol client on the browser's WebSocket endpoint.
+    send() writes a command and reads frames until its answer arrives;
+    events are skipped since nothing subscribes to them.
+    """
+
+    def __init__(self, websocket_url: str, timeout: float = DEVTOOLS_TIMEOUT):
+        url = urllib.parse.urlsplit(websocket_url)
+        self.sock = socket.create_connection((url.hostname, url.port),
+                                             timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f"GET {url.path} HTTP/1.1\r\n" +
+                           f"Host: {url.netloc}\r\n" +
+                           "Upgrade: websocket\r\n" +
+                           "Connection: Upgrade\r\n" +
+                           f"Sec-WebSocket-Key: {key}\r\n" +
+                           "Sec-WebSocket-Version: 13\r\n\r\n").encode())
+        status = self.reader.readline()
+        while self.reader.readline() not in (b"\r\n", b""):
+            pass
+        if b" 101 " not in status:
+            self.close()
+            raise DevToolsError("WebSocket handshake failed: " +
+                                status.decode(errors="replace").strip())
+
+    def send(self, method: str, **params) -> dict:
+        with self.lock:
+            self.next_id += 1
+            self.write_frame(
+                0x1,
+                json.dumps({
+                    "id": self.next_id,
+                    "method": method,
+                    "params": params
+                }).encode())
+            while True:
+                answer = json.loads(self.read_message())
+                if answer.get("id") == self.next_id:
+                    break
+        if "error" in answer:
+            raise DevToolsError(f"{method}: {answer['error'].get('message')}")
+        return answer.get("result", {})
+
+    def write_frame(self, opcode: int, payload: bytes):
+        # Client frames are always final and masked.
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([0x80 | len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([0x80 | 126]) + struct.pack("!H", len(payload))
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", len(payload))
+        mask = os.urandom(4)
+        self.sock.sendall(header + mask +
+                          bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    def read_exactly(self, size: int) -> bytes:
+        data = self.reader.read(size)
+        if len(data) < size:
+            raise DevToolsError("DevTools closed the connection.")
+        return data
+
+    def read_message(self) -> bytes:
+        message = b""
+        while True:
+            head = self.read_exactly(2)
+            opcode, size = head[0] & 0x0F, head[1] & 0x7F
+            if size == 126:
+                size = struct.unpack("!H", self.read_exactly(2))[0]
+            elif size == 127:
+                size = struct.unpack("!Q", self.read_exactly(8))[0]
+            payload = self.read_exactly(size)
+            if opcode == 0x8:
+                raise DevToolsError("DevTools closed the connection.")
+            if opcode == 0x9:
+                self.write_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            message += payload
+            if head[0] & 0x80:
+                return message
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+class LeasedBrowser:
+    """
+    A pool instance leased by one session, and the browser context the
+    session browses in. Like an incognito window, the context starts without
+    cookies, storage, cache or service workers, and it is disposed on
+    close(), or by Chrome when the connection drops, so nothing a session
+    leaves behind is seen by the next one.
+    """
+
+    def __init__(self, instance: dict, lease):
+        if not instance.get("websocket_url"):
+            raise DevToolsError("The browser has no DevTools WebSocket.")
+        self.instance = instance
+        self.lease = lease
+        self.connection = DevToolsConnection(instance["websocket_url"])
+        try:
+            self.context_id = self.connection.send(
+                "Target.createBrowserContext",
+                disposeOnDetach=True,
+                proxyServer=f"http://127.0.0.1:{instance['proxy_port']}"
+            )["browserContextId"]
+        except (OSError, DevToolsError):
+            self.connection.close()
+            raise
+
+    def open_url(self, url: str) -> str:
+        """Opens url in a new tab of the context and returns its target id."""
+        target = self.connection.send("Target.createTarget",
+                                      url=url,
+                                      browserContextId=self.context_id)
+        return target["targetId"]
+
+    def is_target_open(self, target_id: str) -> bool:
+        try:
+            targets = self.connection.send("Target.getTargets")["targetInfos"]
+        except (OSError, DevToolsError):
+            return False
+        return any(target["targetId"] == target_id for target in targets)
+
+    def close_target(self, target_id: str):
+        try:
+            self.connection.send("Target.closeTarget", targetId=target_id)
+        except (OSError, DevToolsError):
+            pass
+
+    def close(self):
+        """Disposes the context with its tabs and releases the lease."""
+        try:
+            self.connection.send("Target.disposeBrowserContext",
+                                 browserContextId=self.context_id)
+        except (OSError, DevToolsError):
+            pass
+        finally:
+            self.connection.close()
+            self.lease.close()
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import uuid
+import tarfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, List, Tuple
+import zstandard
+from .utils import file_sha256
+
+# Bodies with these extensions are already compressed; running them through
+# zstd again costs CPU for next to no gain.
+COMPRESSED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".ico", ".mp4",
+    ".webm", ".m4s", ".ts", ".mp3", ".aac", ".ogg", ".woff", ".woff2",
+    ".gz", ".br", ".zst", ".zip", ".pdf"
+}
+
+def is_compressed(rel_path: str) -> bool:
+    return os.path.splitext(rel_path)[1].lower() in COMPRESSED_EXTENSIONS
+
+def build_manifest(root: Path,
+                   previous: Optional[Dict[str, dict]] = None,
+                   workers: Optional[int] = None) -> Dict[str, dict]:
+    """
+    Returns {relative path: {size, mtime_ns, sha256}} for every file under
+    root. Digests from a previous manifest are reused for files whose size
+    and mtime did not change, everything else is hashed in parallel.
+    """
+    previous = previous or {}
+    manifest = {}
+    to_hash = []
+
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            rel_path = path.relative_to(root).as_posix()
+            stat = path.stat()
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            old = previous.get(rel_path)
+            if old and old["size"] == entry["size"] and old[
+                    "mtime_ns"] == entry["mtime_ns"]:
+                entry["sha256"] = old["sha256"]
+            else:
+                to_hash.append(rel_path)
+            manifest[rel_path] = entry
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rel_path, digest in zip(
+                to_hash,
+                pool.map(lambda p: file_sha256(root / p), to_hash)):
+            manifest[rel_path]["sha256"] = digest
+
+    return dict(sorted(manifest.items()))
+
+def diff_manifests(previous: Dict[str, dict],
+                   current: Dict[str, dict]) -> Tuple[List[str], List[str]]:
+    """Returns (changed or new paths, removed paths)."""
+    changed = [
+        rel_path for rel_path, entry in current.items()
+        if previous.get(rel_path, {}).get("sha256") != entry["sha256"]
+    ]
+    removed = [rel_path for rel_path in previous if rel_path not in current]
+    return changed, removed
+
+def write_tar(root: Path, rel_paths: List[str], fileobj, arc_prefix: str):
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for rel_path in rel_paths:
+            tar.add(root / rel_path, arcname=f"{arc_prefix}/{rel_path}",
+                    recursive=False)
+
+def write_bundle(root: Path,
+                 out_dir: Path,
+                 manifest: Dict[str, dict],
+                 previous: Optional[dict] = None,
+                 skip_compressed: bool = False,
+                 level: int = 3,
+                 threads: int = -1) -> Path:
+    """
+    Packages root into out_dir as bundle-<id>.tar.zst plus, when
+    skip_compressed is set, an uncompressed bundle-<id>.media.tar for files
+    that are already compressed. With a previous bundle description only
+    new or changed files are included and removed paths are recorded.
+
+    Returns the path of the bundle description (bundle-<id>.json).
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # Bundles written within the same second still get distinct ids; the
+    # files are opened exclusively so a bundle is never overwritten.
+    bundle_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    arc_prefix = root.name
+
+    if previous:
+        rel_paths, removed = diff_manifests(previous["manifest"], manifest)
+    else:
+        rel_paths, removed = list(manifest), []
+
+    media = {p for p in rel_paths if skip_compressed and is_compressed(p)}
+    compressible = [p for p in rel_paths if p not in media]
+
+    archives = []
+    data_tar = out_dir / f"bundle-{bundle_id}.tar.zst"
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+    with open(data_tar, 'xb') as f:
+        with compressor.stream_writer(f) as writer:
+            write_tar(root, compressible, writer, arc_prefix)
+    archives.append(data_tar.name)
+
+    if media:
+        media_tar = out_dir / f"bundle-{bundle_id}.media.tar"
+        with open(media_tar, 'xb') as f:
+            write_tar(root, sorted(media), f, arc_prefix)
+        archives.append(media_tar.name)
+
+    description = {
+        "id": bundle_id,
+        "base": previous["id"] if previous else None,
+        "root": arc_prefix,
+        "archives": archives,
+        "files": len(rel_paths),
+        "bytes": sum(manifest[p]["size"] for p in rel_paths),
+        "removed": removed,
+        "manifest": manifest
+    }
+    description_file = out_dir / f"bundle-{bundle_id}.json"
+    with open(description_file, 'x', encoding='utf-8') as f:
+        json.dump(description, f, indent=4)
+
+    return description_file
+
+def extract_member(tar: tarfile.TarFile, member: tarfile.TarInfo,
+                   dest: Path):
+    """
+    tarfile writes over an existing file in place. Processed bodies are
+    hardlinks into the shared body store, so the old file is unlinked first
+    and the store keeps its content.
+    """
+    member = tarfile.data_filter(member, str(dest))
+    target = dest / member.name
+    if not member.isdir() and (target.is_symlink() or target.is_file()):
+        target.unlink()
+    tar.extract(member, dest, filter='data')
+
+def apply_bundle(description_file: Path, dest: Path):
+    """
+    Extracts a bundle into dest. Incremental bundles must be applied on top
+    of their base, in order.
+    """
+    with open(description_file, 'r', encoding='utf-8') as f:
+        description = json.load(f)
+
+    bundle_dir = description_file.parent
+    for archive in description["archives"]:
+        with open(bundle_dir / archive, 'rb') as f:
+            if archive.endswith(".zst"):
+                reader = zstandard.ZstdDecompressor().stream_reader(f)
+            else:
+                reader = f
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                for member in tar:
+                    extract_member(tar, member, dest)
+
+    root = dest / description["root"]
+    for rel_path in description["removed"]:
+        try:
+            (root / rel_path).unlink()
+        except FileNotFoundError:
+            pass
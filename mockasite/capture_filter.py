@@ -0,0 +1,219 @@
+import json
+import time
+import fnmatch
+from collections.abc import Sequence
+from typing import Optional
+from mitmproxy import ctx, http
+from mitmproxy.io import FlowWriter
+
+# Chunks arriving closer together than this are recorded as one.
+CHUNK_MERGE_INTERVAL = 0.01
+
+class CaptureFilter:
+    """
+    mitmdump script addon that records flows to capture_file, dropping or
+    truncating the ones the capture rules exclude before they are written.
+
+    Loaded with `mitmdump -s`, so it must not rely on package relative
+    imports.
+    """
+
+    def __init__(self):
+        self.writer: Optional[FlowWriter] = None
+        self.file = None
+        self.recorded = set()
+        self.stats = {
+            "flows_seen": 0,
+            "flows_written": 0,
+            "flows_dropped": 0,
+            "flows_truncated": 0,
+            "bytes_seen": 0,
+            "bytes_written": 0
+        }
+
+    def load(self, loader):
+        loader.add_option("capture_file", str, "",
+                          "Write the filtered flows to this file.")
+        loader.add_option("capture_stats_file", str, "",
+                          "Write capture statistics as JSON on exit.")
+        loader.add_option(
+            "capture_allow_hosts", Sequence[str], [],
+            "Only record these hosts (glob, subdomains included).")
+        loader.add_option(
+            "capture_deny_hosts", Sequence[str], [],
+            "Never record these hosts (glob, subdomains included).")
+        loader.add_option(
+            "capture_deny_content_types", Sequence[str], [],
+            "Never record responses with these content types (glob).")
+        loader.add_option("capture_max_body_size", int, 0,
+                          "Response body size cap in bytes, 0 for no cap.")
+        loader.add_option(
+            "capture_oversize", str, "truncate",
+            "What to do with bodies over the cap: truncate or drop.")
+
+    def configure(self, updated):
+        if "capture_file" in updated and ctx.options.capture_file:
+            self.close()
+            # pylint: disable=consider-using-with
+            self.file = open(ctx.options.capture_file, 'wb')
+            self.writer = FlowWriter(self.file)
+
+    @staticmethod
+    def host_matches(host: str, patterns: Sequence[str]) -> bool:
+        host = host.lower()
+        for pattern in patterns:
+            pattern = pattern.lower()
+            if fnmatch.fnmatch(host, pattern) or host.endswith(f".{pattern}"):
+                return True
+        return False
+
+    @staticmethod
+    def content_type(flow: http.HTTPFlow) -> str:
+        value = flow.response.headers.get("Content-Type", "")
+        return value.split(';', 1)[0].strip().lower()
+
+    def is_host_recorded(self, host: str) -> bool:
+        if ctx.options.capture_allow_hosts and not self.host_matches(
+                host, ctx.options.capture_allow_hosts):
+            return False
+        return not self.host_matches(host, ctx.options.capture_deny_hosts)
+
+    def is_content_type_recorded(self, flow: http.HTTPFlow) -> bool:
+        content_type = self.content_type(flow)
+        return not any(
+            fnmatch.fnmatch(content_type, pattern.lower())
+            for pattern in ctx.options.capture_deny_content_types)
+
+    @staticmethod
+    def is_stream_candidate(flow: http.HTTPFlow) -> bool:
+        """
+        Responses without a declared length may be event streams, long-polls
+        or chunked streaming, so their chunk timing is recorded. Chunks of an
+        encoded body do not map onto the decoded BODY file, so those are not.
+        """
+        headers = flow.response.headers
+        return "Content-Length" not in headers and headers.get(
+            "Content-Encoding", "identity").lower() == "identity"
+
+    def responseheaders(self, flow: http.HTTPFlow):
+        """
+        Stream bodies that will not be kept in full so they are never buffered
+        in memory; only the part that is recorded is retained.
+        """
+        skip = not (self.is_host_recorded(flow.request.pretty_host)
+                    and self.is_content_type_recorded(flow))
+        cap = ctx.options.capture_max_body_size
+        flow.metadata["capture_skip"] = skip
+
+        if skip:
+            flow.metadata["capture_seen"] = 0
+
+            def count(chunk: bytes) -> bytes:
+                flow.metadata["capture_seen"] += len(chunk)
+                return chunk
+
+            flow.response.stream = count
+            return
+
+        stream_candidate = self.is_stream_candidate(flow)
+        declared = flow.response.headers.get("Content-Length")
+        if cap <= 0 or (declared is not None and declared.isdigit()
+                        and int(declared) <= cap):
+            cap = 0
+            if not stream_candidate:
+                return
+
+        kept = bytearray()
+        # [size, seconds since the response headers] per recorded chunk
+        chunks = []
+        started = time.time()
+        flow.metadata["capture_seen"] = 0
+
+        def keep_head(chunk: bytes) -> bytes:
+            flow.metadata["capture_seen"] += len(chunk)
+            if cap and len(kept) >= cap:
+                return chunk
+            piece = chunk[:cap - len(kept)] if cap else chunk
+            kept.extend(piece)
+            if stream_candidate and piece:
+                offset = time.time() - started
+                if chunks and offset - chunks[-1][1] < CHUNK_MERGE_INTERVAL:
+                    chunks[-1][0] += len(piece)
+                else:
+                    chunks.append([len(piece), round(offset, 6)])
+            return chunk
+
+        flow.response.stream = keep_head
+        flow.metadata["capture_kept"] = kept
+        if stream_candidate:
+            flow.metadata["capture_chunks"] = chunks
+
+    def response(self, flow: http.HTTPFlow):
+        if flow.websocket is None:
+            self.record(flow)
+
+    def error(self, flow: http.HTTPFlow):
+        self.record(flow)
+
+    def websocket_end(self, flow: http.HTTPFlow):
+        self.record(flow)
+
+    def record(self, flow: http.HTTPFlow):
+        if flow.id in self.recorded: return
+        self.recorded.add(flow.id)
+        self.stats["flows_seen"] += 1
+
+        if not flow.response:
+            if self.is_host_recorded(flow.request.pretty_host):
+                self.write(flow, 0)
+            else:
+                self.stats["flows_dropped"] += 1
+            return
+
+        kept = flow.metadata.pop("capture_kept", None)
+        seen = flow.metadata.pop("capture_seen", None)
+        if seen is None:
+            seen = len(flow.response.raw_content or b'')
+        self.stats["bytes_seen"] += seen
+
+        if flow.metadata.pop("capture_skip", False):
+            self.stats["flows_dropped"] += 1
+            return
+
+        if kept is not None:
+            cap = ctx.options.capture_max_body_size
+            if 0 < cap < seen:
+                # A cut off gzip/br/zstd stream cannot be decoded later on,
+                # so encoded bodies are dropped rather than truncated.
+                encoded = flow.response.headers.get(
+                    "Content-Encoding", "identity").lower() != "identity"
+                if ctx.options.capture_oversize == "drop" or encoded:
+                    self.stats["flows_dropped"] += 1
+                    return
+                flow.metadata["capture_truncated_from"] = seen
+                self.stats["flows_truncated"] += 1
+            flow.response.stream = False
+            flow.response.raw_content = bytes(kept)
+
+        self.write(flow, len(flow.response.raw_content or b''))
+
+    def write(self, flow: http.HTTPFlow, size: int):
+        if not self.writer: return
+        self.writer.add(flow)
+        self.stats["flows_written"] += 1
+        self.stats["bytes_written"] += size
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            self.writer = None
+
+    def done(self):
+        self.close()
+        if ctx.options.capture_stats_file:
+            with open(ctx.options.capture_stats_file, 'w',
+                      encoding='utf-8') as f:
+                json.dump(self.stats, f, indent=4)
+
+addons = [CaptureFilter()]
@@ -0,0 +1,112 @@
+import json
+import datetime
+import ipaddress
+from pathlib import Path
+from typing import Iterable, List, Optional
+from cryptography import x509
+from mitmproxy.certs import CertStore, Cert, dummy_cert
+
+CONF_BASENAME = "mitmproxy"
+KEY_SIZE = 2048
+CERT_INDEX_FILE = "index.json"
+
+# Cached leaf certificates are regenerated once they get this close to expiry.
+RENEW_BEFORE = datetime.timedelta(days=7)
+
+def load_ca_store(confdir: Path) -> CertStore:
+    """Loads (or creates) the CA mitmproxy uses for the given confdir."""
+    return CertStore.from_store(confdir, CONF_BASENAME, KEY_SIZE)
+
+def load_ca_file(ca_file: Path, dhparam_file: Path) -> CertStore:
+    return CertStore.from_files(ca_file, dhparam_file)
+
+def ca_fingerprint(store: CertStore) -> str:
+    return store.default_ca.fingerprint().hex()
+
+def read_ca_fingerprint(confdir: Path) -> Optional[str]:
+    """Returns the fingerprint of the CA in confdir without creating one."""
+    ca_file = confdir / f"{CONF_BASENAME}-ca.pem"
+    if not ca_file.exists():
+        return None
+    return Cert.from_pem(ca_file.read_bytes()).fingerprint().hex()
+
+def host_sans(host: str) -> x509.GeneralNames:
+    try:
+        return x509.GeneralNames([x509.IPAddress(ipaddress.ip_address(host))])
+    except ValueError:
+        return x509.GeneralNames([x509.DNSName(host.encode("idna").decode())])
+
+def cert_file_name(host: str) -> str:
+    return f"{host.replace(':', '_')}.pem"
+
+def load_cert_index(cert_dir: Path) -> dict:
+    try:
+        with open(cert_dir / CERT_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"ca": None, "hosts": {}}
+
+def pregenerate_host_certs(store: CertStore, hosts: Iterable[str],
+                           cert_dir: Path) -> int:
+    """
+    Signs a leaf certificate for every host with the store's CA and caches it
+    in cert_dir. Certificates that are still valid for the same CA are kept.
+
+    Leaf certificates generated by mitmproxy share the CA private key, so the
+    cached files only hold the certificate; mitmproxy falls back to the CA key
+    when loading them through the `certs` option.
+
+    Returns the number of certificates generated.
+    """
+    cert_dir.mkdir(parents=True, exist_ok=True)
+    fingerprint = ca_fingerprint(store)
+
+    index = load_cert_index(cert_dir)
+    if index.get("ca") != fingerprint:
+        index = {"ca": fingerprint, "hosts": {}}
+
+    renew_after = datetime.datetime.now(datetime.timezone.utc) + RENEW_BEFORE
+    generated = 0
+    # dummy_cert takes a cryptography certificate; load it from the public
+    # PEM form instead of reaching into Cert.
+    ca_cert = x509.load_pem_x509_certificate(store.default_ca.to_pem())
+
+    for host in hosts:
+        entry = index["hosts"].get(host)
+        if entry and (cert_dir / entry["file"]).exists():
+            not_after = datetime.datetime.fromisoformat(entry["not_after"])
+            if not_after > renew_after: continue
+
+        cert = dummy_cert(store.default_privatekey, ca_cert, host,
+                          host_sans(host))
+        file_name = cert_file_name(host)
+        (cert_dir / file_name).write_bytes(cert.to_pem())
+        index["hosts"][host] = {
+            "file": file_name,
+            "not_after": cert.notafter.isoformat()
+        }
+        generated += 1
+
+    with open(cert_dir / CERT_INDEX_FILE, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+
+    return generated
+
+def get_cert_specs(cert_dir: Path, confdir: Path) -> List[str]:
+    """
+    Returns mitmproxy `certs` option values for the cached leaf certificates
+    that were signed by the CA in confdir and have not expired.
+    """
+    index = load_cert_index(cert_dir)
+    fingerprint = read_ca_fingerprint(confdir)
+    if fingerprint is None or index.get("ca") != fingerprint:
+        return []
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    specs = []
+    for host, entry in index["hosts"].items():
+        cert_file = cert_dir / entry["file"]
+        if not cert_file.exists(): continue
+        if datetime.datetime.fromisoformat(entry["not_after"]) <= now: continue
+        specs.append(f"{host}={cert_file}")
+    return specs
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import threading
+import urllib.request
+import urllib.error
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+from .utils import is_valid_site_name
+
+DAEMON_STATE_FILE = "daemon.json"
+
+CONTROL_COMMANDS = ["stats", "reset", "reload", "switch", "stop"]
+
+class PlaybackDaemon:
+    """
+    State of a long-running playback proxy that the control API acts on.
+
+    addon is the proxy addon whose replayer attribute answers requests.
+    load(sites) builds a new replayer for a list of site names; it is swapped
+    in with a single attribute assignment, so requests in flight finish on
+    the replayer they started with.
+    """
+
+    def __init__(self,
+                 addon,
+                 load: Callable[[List[str]], object],
+                 sites: List[str],
+                 on_stop: Optional[Callable[[], None]] = None,
+                 on_switch: Optional[Callable[[List[str]], None]] = None):
+        self.addon = addon
+        self.load = load
+        self.sites = sites
+        self.on_stop = on_stop
+        self.on_switch = on_switch
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def reset(self) -> dict:
+        started = time.perf_counter()
+        self.addon.replayer.reset()
+        return {"reset": True, "ms": elapsed_ms(started)}
+
+    def reload(self) -> dict:
+        return self.switch(self.sites)
+
+    def switch(self, sites: List[str]) -> dict:
+        started = time.perf_counter()
+        with self.lock:
+            replayer = self.load(sites)
+            self.addon.replayer = replayer
+            self.sites = sites
+            if self.on_switch:
+                self.on_switch(sites)
+        return {"sites": sites, "ms": elapsed_ms(started)}
+
+    def stats(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "sites": self.sites,
+            "uptime": round(time.time() - self.started, 3),
+            "playback": self.addon.replayer.stats()
+        }
+
+    def stop(self) -> dict:
+        if self.on_stop:
+            self.on_stop()
+        return {"stopping": True}
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 3)
+
+def parse_site_names(payload: dict) -> List[str]:
+    sites = payload["sites"]
+    if not isinstance(sites, list) or not sites:
+        raise ValueError("sites must be a non-empty list of site names.")
+    for name in sites:
+        if not isinstance(name, str) or not is_valid_site_name(name):
+            raise ValueError(f"Invalid site name {json.dumps(name)}.")
+    return sites
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """
+    JSON control API. GET /stats, POST /reset, /reload, /stop and
+    POST /switch with {"sites": [...]}.
+
+    Commands must be sent as application/json to a localhost Host. A web
+    page can only send that cross-origin after a CORS preflight, which this
+    server never answers, and a DNS rebinding page sends its own host name.
+    """
+    daemon: PlaybackDaemon = None
+
+    def do_GET(self):
+        if self.path.rstrip('/') == "/stats":
+            self.send_json(200, self.daemon.stats())
+        else:
+            self.send_json(404, {"error": f"Unknown endpoint '{self.path}'."})
+
+    def do_POST(self):
+        command = self.path.strip('/')
+        host = self.headers.get("Host", "").rsplit(':', 1)[0]
+        if host not in ("127.0.0.1", "localhost"):
+            self.send_json(403, {"error": f"Host '{host}' is not allowed."})
+            return
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.split(';', 1)[0].strip().lower() != "application/json":
+            self.send_json(415,
+                           {"error": "Commands must be application/json."})
+            return
+        content_length = int(self.headers.get("Content-Length", 0) or 0)
+        try:
+            payload = json.loads(self.rfile.read(content_length) or b'{}')
+            if command == "reset":
+                result = self.daemon.reset()
+            elif command == "reload":
+                result = self.daemon.reload()
+            elif command == "switch":
+                result = self.daemon.switch(parse_site_names(payload))
+            elif command == "stop":
+                result = self.daemon.stop()
+            elif command == "stats":
+                result = self.daemon.stats()
+            else:
+                self.send_json(404,
+                               {"error": f"Unknown endpoint '{self.path}'."})
+                return
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(200, result)
+
+    def send_json(self, status_code: int, data: dict):
+        body = json.dumps(data, indent=4).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+def start_control_server(daemon: PlaybackDaemon,
+                         port: int) -> ThreadingHTTPServer:
+    """Serves the control API on localhost from a background thread."""
+    handler = type("Handler", (ControlHandler, ), {"daemon": daemon})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,
+                     name="control-api",
+                     daemon=True).start()
+    return server
+
+def read_daemon_state(state_file: Path) -> Optional[dict]:
+    """Returns the state of a running daemon, or None."""
+    if not state_file.exists():
+        return None
+    with open(state_file, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    try:
+        os.kill(state["pid"], 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return state
+
+def write_daemon_state(state_file: Path, state: dict):
+    tmp_file = state_file.with_suffix(".tmp")
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_file, state_file)
+
+def send_control_command(state_file: Path,
+                         command: str,
+                         payload: Optional[dict] = None,
+                         timeout: float = 30) -> dict:
+    """Sends command to the running daemon and returns its JSON answer."""
+    state = read_daemon_state(state_file)
+    if state is None:
+        raise ConnectionError("No playback daemon is running.")
+
+    url = f"http://127.0.0.1:{state['control_port']}/{command}"
+    if command == "stats":
+        request = urllib.request.Request(url)
+    else:
+        request = urllib.request.Request(url,
+                                         data=json.dumps(payload
+                                                         or {}).encode(),
+                                         method="POST")
+        request.add_header("Content-Type", "application/json")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        return json.load(e)
@@ -0,0 +1,93 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+# Written by --process into the www directory, listing every file playback
+# reads with its size and sha256.
+INTEGRITY_MANIFEST_FILE = "integrity.json"
+
+def mmap_sha256(path: Path) -> str:
+    """
+    Hashes a file through a read-only mapping: no read buffers are copied,
+    and hashlib releases the GIL, so threads hash files in parallel.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+def write_integrity_manifest(base_dir: Path, rel_paths: Iterable[str],
+                             known_digests: Dict[str, str]):
+    """
+    known_digests maps relative paths whose sha256 was already computed
+    while processing (the bodies); everything else is hashed here.
+    """
+    files = {}
+    for rel_path in sorted(set(rel_paths)):
+        path = base_dir / rel_path
+        digest = known_digests.get(rel_path) or mmap_sha256(path)
+        files[rel_path] = {"size": path.stat().st_size, "sha256": digest}
+
+    with open(base_dir / INTEGRITY_MANIFEST_FILE, 'w', encoding='utf-8') as f:
+        json.dump({"files": files}, f, indent=4)
+
+def verify_integrity(base_dir: Path,
+                     fast: bool = False,
+                     workers: Optional[int] = None) -> Optional[dict]:
+    """
+    Checks every file of the manifest for presence and size, and unless
+    fast, its sha256. Returns None when there is no manifest.
+    """
+    try:
+        with open(base_dir / INTEGRITY_MANIFEST_FILE, 'r',
+                  encoding='utf-8') as f:
+            files = json.load(f)["files"]
+    except FileNotFoundError:
+        return None
+
+    started = time.perf_counter()
+    result = {"files": len(files), "missing": [], "size_mismatch": []}
+    to_hash = []
+    for rel_path, entry in files.items():
+        try:
+            size = (base_dir / rel_path).stat().st_size
+        except FileNotFoundError:
+            result["missing"].append(rel_path)
+            continue
+        if size != entry["size"]:
+            result["size_mismatch"].append(rel_path)
+        elif not fast:
+            to_hash.append(rel_path)
+
+    if not fast:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            result["digest_mismatch"] = [
+                rel_path for rel_path, digest in zip(
+                    to_hash,
+                    pool.map(lambda p: mmap_sha256(base_dir / p), to_hash))
+                if digest != files[rel_path]["sha256"]
+            ]
+
+    result["bytes"] = sum(entry["size"] for entry in files.values())
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+def is_intact(result: dict) -> bool:
+    return not (result["missing"] or result["size_mismatch"]
+                or result.get("digest_mismatch"))
+
+def print_verification(result: dict, fast: bool):
+    checked = "sizes" if fast else "sizes and digests"
+    print(f"Checked {checked} of {result['files']} files" +
+          f" ({result['bytes']} bytes) in {result['seconds']}s.")
+    for kind, title in (("missing", "Missing"), ("size_mismatch",
+                                                  "Wrong size"),
+                        ("digest_mismatch", "Wrong digest")):
+        for rel_path in result.get(kind, []):
+            print(f"{title}: {rel_path}")
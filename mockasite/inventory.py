@@ -0,0 +1,154 @@
+import json
+from pathlib import Path
+from typing import Dict, Optional
+
+# Processed index written by --process next to url_to_folder_map.json.
+PROCESSED_INDEX_FILE = "processed_index.json"
+
+# Written next to the www directory by --process --delta.
+CHANGE_REPORT_FILE = "changes.json"
+
+def get_content_type(headers) -> str:
+    """The media type of a Content-Type header, without parameters."""
+    content_type = headers.get("Content-Type") or ""
+    return content_type.split(';', 1)[0].strip().lower() or "-"
+
+def index_entry(host: str, status_code: int, content_type: str, size: int,
+                sha256: str) -> dict:
+    return {
+        "host": host,
+        "status": status_code,
+        "content_type": content_type,
+        "bytes": size,
+        "sha256": sha256
+    }
+
+def write_processed_index(base_dir: Path, entries: Dict[str, dict]):
+    with open(base_dir / PROCESSED_INDEX_FILE, 'w', encoding='utf-8') as f:
+        json.dump({"keys": entries}, f, indent=4)
+
+def load_processed_index(base_dir: Path) -> Optional[dict]:
+    try:
+        with open(base_dir / PROCESSED_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def build_inventory(index: dict, top: int = 10) -> dict:
+    """
+    Summarizes a processed index: counts and bytes per host, content type
+    and status code, the largest bodies and how much of the stored data is
+    duplicated across map keys.
+    """
+    groups = {"hosts": {}, "content_types": {}, "statuses": {}}
+    unique = {}
+    total_bytes = 0
+
+    for entry in index["keys"].values():
+        for group, value in (("hosts", entry["host"]),
+                             ("content_types", entry["content_type"]),
+                             ("statuses", str(entry["status"]))):
+            totals = groups[group].setdefault(value, {
+                "count": 0,
+                "bytes": 0
+            })
+            totals["count"] += 1
+            totals["bytes"] += entry["bytes"]
+        total_bytes += entry["bytes"]
+        unique[entry["sha256"]] = entry["bytes"]
+
+    unique_bytes = sum(unique.values())
+    largest = sorted(index["keys"].items(),
+                     key=lambda item: item[1]["bytes"],
+                     reverse=True)[:top]
+
+    return {
+        "responses": len(index["keys"]),
+        "bytes": total_bytes,
+        "unique_bodies": len(unique),
+        "unique_bytes": unique_bytes,
+        "duplicate_ratio":
+        round(1 - unique_bytes / total_bytes, 3) if total_bytes else 0.0,
+        **{
+            group: dict(
+                sorted(totals.items(),
+                       key=lambda item: item[1]["bytes"],
+                       reverse=True))
+            for group, totals in groups.items()
+        }, "largest": [{
+            "key": key,
+            **entry
+        } for key, entry in largest]
+    }
+
+def format_size(size: float) -> str:
+    if size < 1024:
+        return f"{size:.0f} B"
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024
+        if size < 1024 or unit == "GiB":
+            break
+    return f"{size:.1f} {unit}"
+
+def print_inventory(inventory: dict):
+    print(f"{inventory['responses']} responses," +
+          f" {format_size(inventory['bytes'])}." +
+          f" {inventory['unique_bodies']} unique bodies," +
+          f" {format_size(inventory['unique_bytes'])}" +
+          f" ({inventory['duplicate_ratio']:.1%} of the bytes are" +
+          " duplicates).")
+
+    for group, title in (("hosts", "Host"), ("content_types",
+                                              "Content type"),
+                         ("statuses", "Status")):
+        print(f"\n{title:<48} {'Count':>8} {'Size':>12}")
+        for value, totals in inventory[group].items():
+            print(f"{value:<48} {totals['count']:>8}" +
+                  f" {format_size(totals['bytes']):>12}")
+
+    print(f"\n{'Size':>12}  Largest bodies")
+    for entry in inventory["largest"]:
+        print(f"{format_size(entry['bytes']):>12}  {entry['host']}" +
+              f" {entry['key']}")
+
+def diff_processed_indexes(previous: dict, current: dict) -> dict:
+    """
+    Compares two processed indexes by map key. A key changed when its body,
+    status or content type differ.
+    """
+    previous_keys, current_keys = previous["keys"], current["keys"]
+    changed = {
+        key: {
+            "before": previous_keys[key],
+            "after": entry
+        }
+        for key, entry in current_keys.items()
+        if key in previous_keys and any(
+            previous_keys[key][field] != entry[field]
+            for field in ("sha256", "status", "content_type"))
+    }
+    return {
+        "added": {
+            key: entry
+            for key, entry in current_keys.items()
+            if key not in previous_keys
+        },
+        "changed": changed,
+        "removed": {
+            key: entry
+            for key, entry in previous_keys.items()
+            if key not in current_keys
+        },
+        "unchanged":
+        sum(1 for key in current_keys
+            if key in previous_keys and key not in changed)
+    }
+
+def print_changes(changes: dict):
+    for kind, sign in (("added", "+"), ("changed", "~"), ("removed", "-")):
+        for key, entry in changes[kind].items():
+            entry = entry.get("after", entry)
+            print(f"{sign} {entry['host']} {key}")
+    print(f"{len(changes['added'])} added, {len(changes['changed'])} changed," +
+          f" {len(changes['removed'])} removed," +
+          f" {changes['unchanged']} unchanged.")
@@ -8,22 +8,68 @@ import time
 import hashlib
 import json
 import asyncio
-from signal import signal, SIGINT
+import platform
+import resource
+import re
+import zipfile
+from importlib import metadata
+from signal import signal, SIGINT, SIGTERM
 from pathlib import Path
+from typing import List, Optional
 from shutil import which, rmtree, copy
 from urllib.parse import urlparse
 from multiprocessing import Queue
 from queue import Empty
-from mitmproxy.io import FlowReader
+from mitmproxy import http
 from mitmproxy.options import Options
 from mitmproxy.tools.dump import DumpMaster
 from .MockServer import MockServer
+from .Replayer import Replayer, StreamedBody
+from .SiteRouter import SiteRouter
+from .body_cache import BodyCache
+from .stream_relay import StreamRelay
+from .daemon import (PlaybackDaemon, start_control_server, read_daemon_state,
+                     write_daemon_state, send_control_command,
+                     DAEMON_STATE_FILE, CONTROL_COMMANDS)
+from .shaping import Shaper, SHAPING_MODES
+from .access_log import AccessLog, LOG_LEVELS
+from .certificates import (load_ca_store, load_ca_file, pregenerate_host_certs,
+                           get_cert_specs)
 from .ProcessTracker import ProcessTracker
+from .inventory import (get_content_type, index_entry, write_processed_index,
+                        load_processed_index, build_inventory,
+                        print_inventory, diff_processed_indexes,
+                        print_changes, CHANGE_REPORT_FILE,
+                        PROCESSED_INDEX_FILE)
+from .body_store import BodyStore
+from .integrity import (write_integrity_manifest, verify_integrity, is_intact,
+                        print_verification, INTEGRITY_MANIFEST_FILE)
+from .browser_pool import (BrowserPool, LeasedBrowser, DevToolsError,
+                           read_pool_state, lease_instance, POOL_STATE_FILE)
+from .transforms import run_transforms, TRANSFORMS, TRANSFORM_CACHE_FILE
+from .bundle import build_manifest, write_bundle, apply_bundle, is_compressed
+from .streams import (write_response_body, response_body_sha256,
+                      iter_capture_flows)
+from . import standalone
 from .utils import (get_pkg_name, generate_map_key, split_map_key,
                     get_next_available_map_key, re_run_as_sudo,
                     get_user_confirmation, is_root, docker_image_remove,
                     docker_image_exists, get_effective_user, mkdir_p,
-                    ensure_chrome_not_running, find_free_port)
+                    ensure_chrome_not_running, find_free_port,
+                    DEFAULT_CAPTURE_DENY_HOSTS, STREAM_CONTENT_TYPES,
+                    BODY_FINGERPRINT_INDEX_FILE, file_sha256,
+                    body_fingerprint, get_base_map_key, get_processed_hosts,
+                    is_valid_site_name)
+
+EXPORT_PYTHON_VERSION = "3.12"
+EXPORT_MANYLINUX_TAGS = ["manylinux2014", "manylinux_2_28", "manylinux_2_34"]
+
+# Name of the unnamed site that lives directly in ~/.mockasite.
+DEFAULT_SITE = "default"
+
+# Other responses with recorded chunks are replayed as streams when one of
+# the gaps between their chunks is at least this long, in seconds.
+STREAM_GAP_THRESHOLD = 0.5
 
 class OutputFilter(io.TextIOWrapper):
 
@@ -68,11 +114,75 @@ def main():
                         action='store_true',
                         help='Record web interactions for later use.')
 
+    parser.add_argument(
+        '--browser-pool',
+        type=int,
+        metavar='N',
+        help='Keep N headless Chrome instances running, each with its own' +
+        ' profile, proxy port and DevTools port, for --use-pool and' +
+        ' automation to attach to.')
+    parser.add_argument(
+        '--use-pool',
+        action='store_true',
+        help='With --capture or --playback, use a free instance of the' +
+        ' running --browser-pool instead of starting Chrome.')
+
+    parser.add_argument(
+        '--name',
+        type=str,
+        metavar='NAME',
+        help='Work on the named site in ~/.mockasite/sites/NAME instead of' +
+        ' the default one. Applies to capture, process, playback and export.')
+
+    parser.add_argument('--list-sites',
+                        action='store_true',
+                        help='List the processed sites.')
+
     parser.add_argument('--url',
                         type=str,
                         metavar='URL',
                         help='The url to pass to the browser.')
 
+    parser.add_argument('--allow-host',
+                        action='append',
+                        default=[],
+                        metavar='HOST',
+                        help='With --capture, only record these hosts' +
+                        ' (glob, subdomains included). Repeatable.')
+
+    parser.add_argument('--deny-host',
+                        action='append',
+                        default=[],
+                        metavar='HOST',
+                        help='With --capture, never record these hosts' +
+                        ' (glob, subdomains included). Repeatable.')
+
+    parser.add_argument('--deny-content-type',
+                        action='append',
+                        default=[],
+                        metavar='TYPE',
+                        help='With --capture, never record responses of this' +
+                        ' content type, e.g. "video/*". Repeatable.')
+
+    parser.add_argument('--max-response-size',
+                        type=int,
+                        default=0,
+                        metavar='BYTES',
+                        help='With --capture, cap recorded response bodies' +
+                        ' at this many bytes.')
+
+    parser.add_argument('--oversize',
+                        choices=['truncate', 'drop'],
+                        default='truncate',
+                        help='With --max-response-size, truncate or drop' +
+                        ' larger responses. Compressed bodies are always' +
+                        ' dropped.')
+
+    parser.add_argument('--no-default-deny',
+                        action='store_true',
+                        help='With --capture, also record the analytics and' +
+                        ' ad hosts that are skipped by default.')
+
     parser.add_argument('--review-capture',
                         action='store_true',
                         help='Review the last capture.')
@@ -88,10 +198,76 @@ def main():
         ' This will extract and dump HTTP request and response data into a' +
         ' structured directory format.')
 
+    parser.add_argument(
+        '--memory-limit',
+        type=int,
+        default=0,
+        metavar='MB',
+        help='With --process, cap the memory of the processing stage.' +
+        ' Flows that do not fit are skipped and reported.')
+
+    parser.add_argument(
+        '--delta',
+        action='store_true',
+        help='With --process, replace the processed files of the previous' +
+        ' capture and report the added, changed and removed responses.' +
+        ' Unchanged bodies are reused instead of written again.')
+
+    parser.add_argument(
+        '--transform',
+        action='append',
+        default=[],
+        choices=list(TRANSFORMS),
+        help='With --process, post-process the bodies of matching content' +
+        ' types: prettier formats JavaScript and CSS, rewrite-urls applies' +
+        ' --rewrite-url. Can be repeated; transforms run in order.')
+    parser.add_argument('--rewrite-url',
+                        action='append',
+                        default=[],
+                        metavar='OLD=NEW',
+                        help='With --transform rewrite-urls, replace OLD' +
+                        ' with NEW in text bodies. Can be repeated.')
+
+    parser.add_argument(
+        '--ignore-body-field',
+        action='append',
+        default=[],
+        metavar='FIELD',
+        help='With --process, leave this request body field out of the body' +
+        ' fingerprint used to match POST/PUT requests. A plain name matches' +
+        ' at any depth, a dotted path (variables.id) from the root.' +
+        ' Can be repeated.')
+
     parser.add_argument('--review-processed',
                         action='store_true',
                         help='Review processed files.')
 
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='Check the processed files against the digest manifest' +
+        ' written by --process. With --playback or --daemon, check before' +
+        ' serving and refuse to start when files are missing or damaged.')
+    parser.add_argument('--fast',
+                        action='store_true',
+                        help='With --verify, only check that files exist' +
+                        ' and have the recorded size.')
+
+    parser.add_argument(
+        '--inventory',
+        action='store_true',
+        help='Summarize the processed files by host, content type and' +
+        ' status from the index written by --process.')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        metavar='N',
+                        help='With --inventory, number of largest bodies to' +
+                        ' list (default: 10).')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='With --inventory, print the summary as JSON.')
+
     parser.add_argument('--delete-processed',
                         action='store_true',
                         help='Delete processed files.')
@@ -106,11 +282,110 @@ def main():
         help=
         'Replay processed data as a functioning interactive mock of the original site.'
     )
+    parser.add_argument(
+        '--single-process',
+        action='store_true',
+        help='With --playback, serve recorded responses directly from the' +
+        ' proxy event loop instead of a separate mock server process.')
+    parser.add_argument(
+        '--shaping',
+        type=str,
+        default='off',
+        metavar='MODE',
+        help='With --playback, delay responses to emulate network timing: ' +
+        ', '.join(SHAPING_MODES) + '.')
+    parser.add_argument(
+        '--access-log',
+        type=str,
+        default='-',
+        metavar='PATH',
+        help='With --playback, append the JSON lines access log to PATH' +
+        ' instead of stdout.')
+    parser.add_argument(
+        '--log-level',
+        choices=list(LOG_LEVELS),
+        default='info',
+        help='With --playback, log every hit (info), only misses (warning),' +
+        ' hits with their recorded files (debug) or nothing (off).')
+    parser.add_argument(
+        '--log-sample',
+        type=float,
+        default=1.0,
+        metavar='RATE',
+        help='With --playback, fraction of hits that are logged (0 to 1).' +
+        ' Misses are always logged.')
+    parser.add_argument(
+        '--sites',
+        nargs='+',
+        metavar='NAME',
+        help='With --playback, serve these processed sites from one server,' +
+        f' routed by host. Use "{DEFAULT_SITE}" for the unnamed site.')
+    parser.add_argument(
+        '--body-cache-mb',
+        type=int,
+        default=256,
+        metavar='MB',
+        help='With --sites, size of the response body cache the sites share.' +
+        ' Identical bodies are cached once. 0 disables it.')
+
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='Run playback headless and keep it running, with a local' +
+        ' control API to reset, reload, switch sites and read stats.' +
+        ' Accepts the --playback options.')
+    parser.add_argument('--proxy-port',
+                        type=int,
+                        default=0,
+                        metavar='PORT',
+                        help='With --daemon, proxy port (default: a free one).')
+    parser.add_argument(
+        '--control-port',
+        type=int,
+        default=0,
+        metavar='PORT',
+        help='With --daemon, control API port (default: a free one).')
+    parser.add_argument(
+        '--control',
+        choices=CONTROL_COMMANDS,
+        metavar='COMMAND',
+        help='Send a command to the running daemon: ' +
+        ', '.join(CONTROL_COMMANDS) + '. switch takes --sites.')
+
     parser.add_argument(
         '--export',
         action='store_true',
         help='Export a standalone server that serves the mock website.')
 
+    parser.add_argument(
+        '--export-zipapp',
+        action='store_true',
+        help='Export the mock website as a self-contained Python zipapp' +
+        ' that only needs the standard library to run.')
+
+    parser.add_argument(
+        '--export-bundle',
+        action='store_true',
+        help='Package the processed files into a zstd compressed bundle.')
+
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='With --export-bundle, only include files that are new or' +
+        ' changed since the previous bundle.')
+
+    parser.add_argument(
+        '--skip-compressed',
+        action='store_true',
+        help='With --export-bundle, store already compressed media' +
+        ' (images, video, fonts, archives) without recompressing it.')
+
+    parser.add_argument(
+        '--apply-bundle',
+        type=str,
+        metavar='BUNDLE_JSON',
+        help='Extract a bundle (and removals) into the playback storage path.')
+
     parser.add_argument(
         '--dev',
         action='store_true',
@@ -119,29 +394,119 @@ def main():
 
     args = parser.parse_args()
 
-    if args.capture:
-        ensure_chrome_not_running()
-        capture(url=args.url)
+    if args.name:
+        if not is_valid_site_name(args.name):
+            print(f"Error: invalid site name '{args.name}'. Use letters," +
+                  " digits, '.', '_' and '-'.")
+            return 1
+        # Set in the environment so child processes pick the same site.
+        os.environ[f"{pkg_name.upper()}_SITE"] = args.name
+
+    for name in args.sites or []:
+        error = get_site_error(name)
+        if error:
+            print(f"Error: {error}")
+            return 1
+
+    if args.list_sites:
+        list_sites()
+    elif args.browser_pool is not None:
+        if args.browser_pool < 1:
+            print("Error: --browser-pool needs at least one instance.")
+            return
+        run_browser_pool(args.browser_pool)
+    elif args.capture:
+        if not args.use_pool:
+            ensure_chrome_not_running()
+        deny_hosts = list(args.deny_host)
+        if not args.no_default_deny:
+            deny_hosts.extend(sorted(DEFAULT_CAPTURE_DENY_HOSTS))
+        capture(url=args.url,
+                capture_rules={
+                    "capture_allow_hosts": args.allow_host,
+                    "capture_deny_hosts": deny_hosts,
+                    "capture_deny_content_types": args.deny_content_type,
+                    "capture_max_body_size": args.max_response_size,
+                    "capture_oversize": args.oversize
+                },
+                use_pool=args.use_pool)
     elif args.review_capture:
         review_capture()
     elif args.delete_capture:
         delete_last_capture()
     elif args.process:
-        process_capture()
+        rewrite_urls = [tuple(r.split('=', 1)) for r in args.rewrite_url]
+        if any(len(r) != 2 or not r[0] for r in rewrite_urls):
+            print("Error: --rewrite-url takes OLD=NEW.")
+            return
+        if "rewrite-urls" in args.transform and not rewrite_urls:
+            print("Error: --transform rewrite-urls needs --rewrite-url.")
+            return
+        process_capture(memory_limit_mb=args.memory_limit,
+                        ignore_body_fields=args.ignore_body_field,
+                        delta=args.delta,
+                        transforms=args.transform,
+                        transform_options={"rewrite_urls": rewrite_urls})
     elif args.review_processed:
         review_processed()
+    elif args.inventory:
+        inventory(top=args.top, as_json=args.json)
+    elif args.verify and not (args.playback or args.daemon):
+        return 0 if verify_processed(fast=args.fast) else 1
     elif args.delete_processed:
         delete_processed_files()
     elif args.delete_all:
         delete_last_capture()
         delete_processed_files()
         delete_docker_export()
-    elif args.playback:
-        if not is_docker():
+    elif args.playback or args.daemon:
+        if args.playback and not args.use_pool and not is_docker():
             ensure_chrome_not_running()
-        playback(ptracker)
+        try:
+            Shaper.parse(args.shaping)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        if not 0.0 <= args.log_sample <= 1.0:
+            print("Error: --log-sample must be between 0 and 1.")
+            return
+        if args.verify and not verify_processed(args.sites, args.fast):
+            return 1
+        if args.daemon:
+            run_daemon(sites=args.sites,
+                       proxy_port=args.proxy_port,
+                       control_port=args.control_port,
+                       shaping=args.shaping,
+                       access_log_options={
+                           "path": args.access_log,
+                           "level": args.log_level,
+                           "sample": args.log_sample
+                       },
+                       body_cache_mb=args.body_cache_mb)
+            return 0
+        playback(ptracker,
+                 single_process=args.single_process,
+                 shaping=args.shaping,
+                 access_log_options={
+                     "path": args.access_log,
+                     "level": args.log_level,
+                     "sample": args.log_sample
+                 },
+                 sites=args.sites,
+                 body_cache_mb=args.body_cache_mb,
+                 use_pool=args.use_pool)
+    elif args.control:
+        control_daemon(args.control, args.sites)
     elif args.export:
         export(dev=args.dev)
+    elif args.export_zipapp:
+        export_zipapp()
+    elif args.export_bundle:
+        export_bundle(incremental=args.incremental,
+                      skip_compressed=args.skip_compressed)
+    elif args.apply_bundle:
+        apply_bundle(Path(args.apply_bundle),
+                     get_playback_storage_path().parent)
     else:
         parser.print_help()
 
@@ -175,6 +540,7 @@ def delete_processed_files():
             print(f"Delete '{playback_storage_path}'")
         except OSError as e:
             print(f"Error: {e.strerror}")
+    get_body_store().prune()
 
 def delete_docker_export():
     image_name = f"{get_pkg_name()}_export"
@@ -216,9 +582,17 @@ def is_port_open(host, port):
         except (socket.timeout, ConnectionRefusedError):
             return False
 
-def capture(url: str):
-    port = find_free_port()
-    proc = launch_mitmdump(port)
+def capture(url: str,
+            capture_rules: Optional[dict] = None,
+            use_pool: bool = False):
+    pooled = lease_pooled_browser() if use_pool else None
+    if use_pool and pooled is None:
+        return
+    port = pooled.instance["proxy_port"] if pooled else find_free_port()
+    stats_file = get_capture_storage_path() / "capture_stats.json"
+    if stats_file.exists():
+        stats_file.unlink()
+    proc = launch_mitmdump(port, capture_rules or {}, stats_file)
 
     playback_metadata_path = get_capture_storage_path(
     ) / "playback_metadata.json"
@@ -229,9 +603,32 @@ def capture(url: str):
     while not is_port_open("localhost", port):
         time.sleep(1)
 
-    launch_chrome_with_proxy(port, url)
+    if pooled:
+        try:
+            browse_in_pooled_browser(pooled, url)
+        finally:
+            pooled.close()
+    else:
+        launch_chrome_with_proxy(port, url)
 
     proc.terminate()
+    proc.wait()
+
+    print_capture_stats(stats_file)
+
+def print_capture_stats(stats_file: Path):
+    try:
+        with open(stats_file, 'r', encoding='utf-8') as f:
+            stats = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+
+    saved = stats["bytes_seen"] - stats["bytes_written"]
+    print(f"Captured {stats['flows_written']} of {stats['flows_seen']} flows" +
+          f" ({stats['flows_dropped']} dropped," +
+          f" {stats['flows_truncated']} truncated)." +
+          f" Wrote {stats['bytes_written']} of {stats['bytes_seen']}" +
+          f" body bytes, {saved} bytes saved.")
 
 def review_capture():
     last_capture_file = get_last_capture_file()
@@ -264,8 +661,44 @@ def review_processed():
     except subprocess.CalledProcessError as e:
         print(f"{e}")
 
-def run_playback_server(output: Queue, url_to_folder_map_file: Path, port: int, entry_url: str):
-    server = MockServer(url_to_folder_map_file, port, entry_url)
+def inventory(top: int = 10, as_json: bool = False):
+    index = load_processed_index(get_playback_storage_path())
+    if index is None:
+        print("No processed index found. Run --process first.")
+        return
+
+    summary = build_inventory(index, top)
+    if as_json:
+        print(json.dumps(summary, indent=4))
+    else:
+        print_inventory(summary)
+
+def verify_processed(sites: Optional[List[str]] = None,
+                     fast: bool = False) -> bool:
+    intact = True
+    for name in sites or [None]:
+        result = verify_integrity(get_playback_storage_path(name), fast)
+        if result is None:
+            print(f"No digest manifest for site '{name or DEFAULT_SITE}'." +
+                  " Run --process again to write one.")
+            intact = False
+            continue
+        print_verification(result, fast)
+        intact = intact and is_intact(result)
+    if not intact:
+        print("The processed files are incomplete or damaged.")
+    return intact
+
+def run_playback_server(output: Queue, url_to_folder_map_file: Path, port: int, entry_url: str, shaping: str = "off", access_log_options: dict = None, sites: list = None, body_cache_mb: int = 0):
+    # The writer thread must be started in the server process itself.
+    shaper = Shaper.parse(shaping)
+    access_log = AccessLog(**(access_log_options or {}))
+    router = None
+    if sites:
+        router = SiteRouter(sites, shaper, access_log,
+                            get_body_cache(body_cache_mb))
+    server = MockServer(url_to_folder_map_file, port, entry_url, shaper,
+                        access_log, router)
     try:
         server.run()
     except Exception as e:
@@ -276,43 +709,152 @@ def run_playback_server(output: Queue, url_to_folder_map_file: Path, port: int,
 def is_docker() -> bool:
     return os.getenv(f"{get_pkg_name().upper()}_ENV") == "DOCKER"
 
-def playback(ptracker: ProcessTracker):
-    playback_storage_path = get_playback_storage_path()
+def get_site_name() -> Optional[str]:
+    return os.getenv(f"{get_pkg_name().upper()}_SITE") or None
+
+def get_site_error(name: str) -> Optional[str]:
+    """
+    Why name cannot be used as an existing site, or None. Only looks at the
+    file system, so a mistyped name does not leave an empty site behind.
+    """
+    if not is_valid_site_name(name):
+        return (f"invalid site name '{name}'. Use letters, digits, '.'," +
+                " '_' and '-'.")
+    if not get_site_storage_path(name).is_dir():
+        return f"there is no site named '{name}'. See --list-sites."
+    return None
+
+def load_site(name: Optional[str] = None) -> Optional[tuple]:
+    """
+    Returns (name, url_to_folder_map_file, entry_url) for a processed site,
+    or None after reporting why it cannot be played back.
+    """
+    if name is not None:
+        error = get_site_error(name)
+        if error:
+            print(f"Error: {error}")
+            return None
+    playback_storage_path = get_playback_storage_path(name)
     is_directory_empty = len(os.listdir(playback_storage_path)) == 0
     if is_directory_empty:
         print(f"Playback storage path '{playback_storage_path}' is empty.")
-        return
+        return None
 
     url_to_folder_map_file = get_url_to_folder_map_file(playback_storage_path)
 
     if not url_to_folder_map_file.exists():
         print(f"Playback map file '{url_to_folder_map_file}' does not exist." +
               " Try running --process first.")
-        return
-
-    proxy_port = 8080 if is_docker() else find_free_port()
-    playback_port = find_free_port(starting_from=5000)
-
-    binding = '0.0.0.0' # Any
-    output = Queue()
+        return None
 
-    playback_metadata_path = get_playback_storage_path(
-    ) / "playback_metadata.json"
+    playback_metadata_path = playback_storage_path / "playback_metadata.json"
     try:
         with open(playback_metadata_path, 'r', encoding='utf-8') as f:
             metadata = json.load(f)
             url = metadata["url"]
     except (FileNotFoundError, ValueError) as e:
         print(f"Error loading playback metadata: {e}")
+        return None
+
+    return name or get_site_name() or DEFAULT_SITE, url_to_folder_map_file, url
+
+def list_sites():
+    names = [DEFAULT_SITE]
+    sites_dir = get_pkg_storage_path() / "sites"
+    if sites_dir.is_dir():
+        names.extend(sorted(p.name for p in sites_dir.iterdir() if p.is_dir()))
+
+    for name in names:
+        playback_storage_path = get_site_storage_path(
+            name) / "playback" / "www"
+        metadata_file = playback_storage_path / "playback_metadata.json"
+        if not get_url_to_folder_map_file(playback_storage_path).exists():
+            continue
+        try:
+            with open(metadata_file, 'r', encoding='utf-8') as f:
+                url = json.load(f).get("url")
+        except (FileNotFoundError, ValueError):
+            print(f"{name}: no playback metadata, run --process again.")
+            continue
+        print(f"{name}: {url}")
+
+def get_body_cache(body_cache_mb: int) -> Optional[BodyCache]:
+    if body_cache_mb <= 0:
+        return None
+    return BodyCache(body_cache_mb * 1024 * 1024)
+
+def playback(ptracker: ProcessTracker,
+             single_process: bool = False,
+             shaping: str = "off",
+             access_log_options: dict = None,
+             sites: Optional[List[str]] = None,
+             body_cache_mb: int = 0,
+             use_pool: bool = False):
+    """
+    Plays back the current site, or with sites, several sites from one
+    server. The browser opens the entry URL of the first one.
+    """
+    loaded_sites = []
+    for name in sites or [None]:
+        site = load_site(name)
+        if site is None:
+            return
+        loaded_sites.append(site)
+
+    pooled = lease_pooled_browser() if use_pool else None
+    if use_pool and pooled is None:
+        return
+    _, url_to_folder_map_file, url = loaded_sites[0]
+    cert_dirs = [get_host_cert_dir(name) for name in sites or [None]]
+
+    if pooled:
+        proxy_port = pooled.instance["proxy_port"]
+    else:
+        proxy_port = 8080 if is_docker() else find_free_port()
+    playback_port = find_free_port(starting_from=5000)
+
+    binding = '0.0.0.0' # Any
+    output = Queue()
+
+    def open_pooled_tab():
+        pooled.open_url(url)
+
+    # Disposes the pooled browser context and its tabs when playback ends.
+    def close_pooled_browser():
+        if pooled:
+            pooled.close()
+
+    if single_process:
+        on_running = None
+        if pooled:
+            on_running = open_pooled_tab
+        elif not is_docker():
+            on_running = lambda: ptracker.start(
+                get_chrome_cmd(proxy_port, url), output)
+        shaper = Shaper.parse(shaping)
+        access_log = AccessLog(**(access_log_options or {}))
+        router = None
+        if sites:
+            router = SiteRouter(loaded_sites, shaper, access_log,
+                                get_body_cache(body_cache_mb))
+        try:
+            run_integrated_playback(binding, proxy_port,
+                                    url_to_folder_map_file, url, on_running,
+                                    shaper, access_log, router, cert_dirs)
+        finally:
+            close_pooled_browser()
+            ptracker.terminate_all()
         return
 
-    ptracker.start(run_playback_server, output, url_to_folder_map_file, playback_port, url)
-    ptracker.start(start_proxy_server, output, binding, proxy_port, playback_port)
+    ptracker.start(run_playback_server, output, url_to_folder_map_file, playback_port, url, shaping, access_log_options, loaded_sites if sites else None, body_cache_mb)
+    ptracker.start(start_proxy_server, output, binding, proxy_port, playback_port, cert_dirs)
 
     while not is_port_open("localhost", proxy_port):
         time.sleep(1)
 
-    if not is_docker():
+    if pooled:
+        open_pooled_tab()
+    elif not is_docker():
         ptracker.start(get_chrome_cmd(proxy_port, url), output)
 
     try:
@@ -329,6 +871,7 @@ def playback(ptracker: ProcessTracker):
                 time.sleep(1)
 
     finally:
+        close_pooled_browser()
         ptracker.terminate_all()
 
 class Addon:
@@ -336,20 +879,116 @@ class Addon:
         self.port = port
 
     def request(self, flow):
+        flow.request.headers[MockServer.HOST_HEADER] = flow.request.pretty_host
         flow.request.host = "localhost"
         flow.request.port = self.port
         flow.request.scheme = "http"
 
+    async def responseheaders(self, flow):
+        # Recorded streams are forwarded chunk by chunk as MockServer yields
+        # them, so their delay has to be applied before the body.
+        if flow.response.headers.pop(MockServer.STREAM_HEADER, None):
+            flow.response.stream = True
+            await self.shape(flow)
+
+    async def response(self, flow):
+        await self.shape(flow)
+
+    async def shape(self, flow):
+        # Shaping delays are awaited here rather than slept in a Flask worker.
+        delay = flow.response.headers.pop(MockServer.DELAY_HEADER, None)
+        if delay:
+            await asyncio.sleep(float(delay))
+
+# Marks flows that PlaybackAddon forwards to its StreamRelay.
+STREAM_RELAY_METADATA = "mockasite_stream_relay"
+
+class PlaybackAddon:
+    """Answers proxied requests from the recorded data without forwarding."""
+
+    def __init__(self, replayer: Replayer, on_running=None):
+        self.replayer = replayer
+        self.on_running = on_running
+        # Started with the first recorded stream.
+        self.stream_relay: Optional[StreamRelay] = None
+
+    def running(self):
+        if self.on_running:
+            self.on_running()
+
+    def done(self):
+        if self.stream_relay:
+            self.stream_relay.close()
+
+    async def request(self, flow):
+        http_method = flow.request.method.upper()
+        origin_header = flow.request.headers.get("Origin", "no_origin")
+        path = urlparse(flow.request.pretty_url).path
+        query_params = list(flow.request.query.keys())
+
+        status_code, headers, body, delay = await asyncio.to_thread(
+            self.replayer.replay, http_method, path, query_params,
+            origin_header, flow.request.get_content(strict=False),
+            flow.request.headers.get("Content-Type"), flow.request.pretty_host)
+
+        headers = self.replayer.add_cors_headers(headers, http_method,
+                                                 flow.request.headers)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if isinstance(body, StreamedBody):
+            # An addon can only answer with a complete body, so recorded
+            # streams are fetched from the relay and passed on unbuffered.
+            if self.stream_relay is None:
+                self.stream_relay = StreamRelay()
+            flow.request.path = self.stream_relay.park(status_code, headers,
+                                                       body)
+            flow.request.host = "127.0.0.1"
+            flow.request.port = self.stream_relay.port
+            flow.request.scheme = "http"
+            flow.metadata[STREAM_RELAY_METADATA] = True
+            return
+
+        flow.response = http.Response.make(status_code, body, headers)
+
+    def responseheaders(self, flow):
+        if flow.metadata.get(STREAM_RELAY_METADATA):
+            flow.response.stream = True
+
 def get_mitm_confdir_runtime() -> Path:
     if is_docker():
         return Path("/app") / "mitmproxy-conf"
     return Path.home() / f".{get_pkg_name()}" / "certificates"
 
-def start_proxy_server(output: Queue, binding: str, proxy_port: int, playback_port: int):
+def get_host_cert_dir(name: Optional[str] = None) -> Path:
+    return get_playback_storage_path(name).parent / "certs"
+
+def get_site_cert_specs(cert_dirs: Optional[List[Path]] = None) -> List[str]:
+    """Cached certificates of the given sites (default: the current one)."""
+    confdir = get_mitm_confdir_runtime()
+    return [
+        spec for cert_dir in cert_dirs or [get_host_cert_dir()]
+        for spec in get_cert_specs(cert_dir, confdir)
+    ]
+
+def cache_host_certs(url_to_folder_map: dict, cert_dir: Path, store=None):
+    """Pre-generates leaf certificates for every host in a processed map."""
+    if store is None:
+        confdir = get_mitm_confdir_runtime()
+        confdir.mkdir(parents=True, exist_ok=True)
+        store = load_ca_store(confdir)
+    hosts = get_processed_hosts(url_to_folder_map)
+    generated = pregenerate_host_certs(store, hosts, cert_dir)
+    print(f"Cached TLS certificates for {len(hosts)} hosts" +
+          f" ({generated} newly generated) in '{cert_dir}'.")
+
+def start_proxy_server(output: Queue, binding: str, proxy_port: int, playback_port: int, cert_dirs: Optional[List[Path]] = None):
 
     async def run_proxy():
         confdir = str(get_mitm_confdir_runtime())
-        options = Options(listen_host=binding, listen_port=proxy_port, confdir=confdir)
+        certs = get_site_cert_specs(cert_dirs)
+        options = Options(listen_host=binding, listen_port=proxy_port,
+                          confdir=confdir, certs=certs)
         m = DumpMaster(options, with_termlog=False, with_dumper=False)
         m.addons.add(Addon(playback_port))
 
@@ -366,62 +1005,252 @@ def start_proxy_server(output: Queue, binding: str, proxy_port: int, playback_po
     loop.run_until_complete(run_proxy())
     loop.close()
 
+def create_playback_master(binding: str, proxy_port: int,
+                           addon: PlaybackAddon,
+                           cert_dirs: Optional[List[Path]] = None):
+    """Must be called from a running event loop."""
+    confdir = str(get_mitm_confdir_runtime())
+    certs = get_site_cert_specs(cert_dirs)
+    options = Options(listen_host=binding, listen_port=proxy_port,
+                      confdir=confdir, certs=certs)
+    m = DumpMaster(options, with_termlog=False, with_dumper=False)
+    # Nothing is forwarded, so never open upstream connections.
+    m.options.update(connection_strategy="lazy", upstream_cert=False)
+    m.addons.add(addon)
+    return m
+
+def build_replayer(site_names: List[str], shaper: Shaper,
+                   access_log: AccessLog, body_cache: Optional[BodyCache]):
+    """
+    A Replayer for one site, or a SiteRouter for several. Raises ValueError
+    when a site cannot be loaded.
+    """
+    loaded_sites = []
+    for name in site_names:
+        site = load_site(name)
+        if site is None:
+            raise ValueError(f"Cannot load site '{name}'.")
+        loaded_sites.append(site)
+
+    if len(loaded_sites) == 1:
+        _, url_to_folder_map_file, entry_url = loaded_sites[0]
+        return Replayer(url_to_folder_map_file, entry_url, shaper,
+                        access_log, body_cache)
+    return SiteRouter(loaded_sites, shaper, access_log, body_cache)
+
+def get_daemon_state_file() -> Path:
+    return get_pkg_storage_path() / DAEMON_STATE_FILE
+
+def run_daemon(sites: Optional[List[str]] = None,
+               proxy_port: int = 0,
+               control_port: int = 0,
+               shaping: str = "off",
+               access_log_options: dict = None,
+               body_cache_mb: int = 0):
+    """
+    Headless single-process playback that keeps running between tests. The
+    ports are written to ~/.mockasite/daemon.json for fixtures to pick up.
+    """
+    state_file = get_daemon_state_file()
+    state = read_daemon_state(state_file)
+    if state is not None:
+        print(f"A playback daemon is already running [{state['pid']}]," +
+              f" control port {state['control_port']}.")
+        return
+
+    shaper = Shaper.parse(shaping)
+    access_log = AccessLog(**(access_log_options or {}))
+    body_cache = get_body_cache(body_cache_mb)
+    load = lambda names: build_replayer(names, shaper, access_log, body_cache)
+
+    names = sites or [get_site_name() or DEFAULT_SITE]
+    try:
+        replayer = load(names)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    binding = '0.0.0.0' # Any
+    proxy_port = proxy_port or (8080 if is_docker() else find_free_port())
+    control_port = control_port or find_free_port(starting_from=proxy_port +
+                                                  1)
+
+    async def run_proxy():
+        addon = PlaybackAddon(replayer)
+        m = create_playback_master(binding, proxy_port, addon,
+                                   [get_host_cert_dir(n) for n in names])
+        loop = asyncio.get_running_loop()
+
+        def update_certs(site_names: List[str]):
+            certs = get_site_cert_specs(
+                [get_host_cert_dir(n) for n in site_names])
+            loop.call_soon_threadsafe(lambda: m.options.update(certs=certs))
+
+        daemon = PlaybackDaemon(addon,
+                                load,
+                                names,
+                                on_stop=lambda: loop.call_soon_threadsafe(
+                                    m.shutdown),
+                                on_switch=update_certs)
+        server = start_control_server(daemon, control_port)
+        write_daemon_state(
+            state_file, {
+                "pid": os.getpid(),
+                "proxy_port": proxy_port,
+                "control_port": control_port,
+                "sites": names
+            })
+        print(f"Playback daemon proxy port={proxy_port}," +
+              f" control port={control_port}. [{os.getpid()}]",
+              flush=True)
+        try:
+            await m.run()
+        finally:
+            server.shutdown()
+            state_file.unlink(missing_ok=True)
+
+    asyncio.run(run_proxy())
+
+def control_daemon(command: str, sites: Optional[List[str]] = None):
+    payload = None
+    if command == "switch":
+        if not sites:
+            print("Error: switch needs --sites.")
+            return
+        payload = {"sites": sites}
+    try:
+        result = send_control_command(get_daemon_state_file(), command,
+                                      payload)
+    except (ConnectionError, OSError) as e:
+        print(f"Error: {e}")
+        return
+    print(json.dumps(result, indent=4))
+
+def run_integrated_playback(binding: str, proxy_port: int,
+                            url_to_folder_map_file: Path, entry_url: str,
+                            on_running=None, shaper: Shaper = None,
+                            access_log: AccessLog = None, replayer=None,
+                            cert_dirs: Optional[List[Path]] = None):
+    """
+    Runs the proxy and the replay handler on one event loop. replayer
+    replaces the Replayer built from url_to_folder_map_file.
+    """
+
+    async def run_proxy():
+        m = create_playback_master(
+            binding, proxy_port,
+            PlaybackAddon(
+                replayer or Replayer(url_to_folder_map_file, entry_url,
+                                     shaper, access_log), on_running),
+            cert_dirs)
+
+        try:
+            await m.run()
+        except KeyboardInterrupt:
+            m.shutdown()
+
+    print(
+        f"Starting single-process playback binding={binding}, port={proxy_port}. [{os.getpid()}]"
+    )
+    asyncio.run(run_proxy())
+
 def export(dev: bool = False):
     re_run_as_sudo()
 
     playback_storage_path = get_playback_storage_path()
-    playback_tar = "playback.tar.gz"
-    image_name = f"{get_pkg_name()}_export"
+    pkg_name = get_pkg_name()
+    image_name = f"{pkg_name}_export"
     image_tar = f"{image_name}.tar"
 
-    certdir = Path.home() / f".{get_pkg_name()}" / "certificates"
+    # The build context is the package directory itself so the playback data
+    # is sent to docker as-is instead of being copied or tarred first.
+    context_dir = get_pkg_storage_path()
+    export_dir = get_export_storage_path()
+
+    certdir = context_dir / "certificates"
     ca_src = certdir / "mockasiteCA.pem"
-    ca_dest = Path("mitmproxy-ca.pem")
+    ca_dest = export_dir / "mitmproxy-ca.pem"
 
     if not ca_src.exists():
         print(f"ERROR: {ca_src} not found. Run generate_cert first.")
         return
 
-    subprocess.run(["cp", str(ca_src), str(ca_dest)], check=True)
+    # The image starts playback with --verify, which refuses to serve a tree
+    # without a digest manifest.
+    if not (playback_storage_path / INTEGRITY_MANIFEST_FILE).exists():
+        print(f"ERROR: No digest manifest in '{playback_storage_path}'." +
+              " Run --process again before exporting.")
+        return
 
-    try:
-        subprocess.run(["rm", "-f", playback_tar], check=True)
-        subprocess.run([
-            "tar", "czvf", playback_tar, "-C", playback_storage_path / "..",
-            "www"
-        ],
-                       check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error durring export: {e}")
+    copy(ca_src, ca_dest)
 
-    pkg_name = get_pkg_name()
-    branch = "dev" if dev else "main"
-    dockerfile_content = f"""
-    FROM python:3.12-slim
+    # Named sites live further down in the build context.
+    playback_context_path = playback_storage_path.relative_to(
+        context_dir).as_posix()
 
-    ENV {pkg_name.upper()}_ENV=DOCKER
+    url_to_folder_map_file = get_url_to_folder_map_file(playback_storage_path)
+    if url_to_folder_map_file.exists():
+        with open(url_to_folder_map_file, 'r', encoding='utf-8') as f:
+            url_to_folder_map = json.load(f)
+        export_store = load_ca_file(ca_src, certdir / "mitmproxy-dhparam.pem")
+        cache_host_certs(url_to_folder_map, export_dir / "certs", export_store)
+    else:
+        (export_dir / "certs").mkdir(exist_ok=True)
 
-    WORKDIR /app
+    source_root = get_source_root()
+    if source_root:
+        wheel = build_local_wheel(source_root, export_dir / "dist")
+        if not wheel or not ensure_wheelhouse(wheel,
+                                              export_dir / "wheelhouse"):
+            return
+        install_steps = f"""
+    COPY export/wheelhouse /wheels
 
-    RUN mkdir -p /app/playback
+    RUN pip install --no-index --find-links /wheels -r /wheels/requirements.txt
 
+    COPY export/dist/{wheel.name} /wheels/{wheel.name}
+
+    RUN pip install --no-index --no-deps /wheels/{wheel.name}
+    """
+    else:
+        branch = "dev" if dev else "main"
+        print("No local source tree found, installing from the" +
+              f" '{branch}' branch instead.")
+        install_steps = f"""
     RUN apt-get update && apt-get install -y git
 
-    COPY {playback_tar} /app/playback/{playback_tar}
+    RUN pip install git+https://github.com/chrisg123/{pkg_name}.git@{branch}
+    """
+
+    # Layers are ordered from least to most frequently changing, the
+    # recorded data comes last.
+    dockerfile_content = f"""
+    FROM python:{EXPORT_PYTHON_VERSION}-slim
 
-    RUN tar -xzvf /app/playback/{playback_tar} -C /app/playback
+    ENV {pkg_name.upper()}_ENV=DOCKER
 
-    COPY mitmproxy-ca.pem /app/mitmproxy-conf/mitmproxy-ca.pem
+    WORKDIR /app
+    {install_steps}
+    COPY export/mitmproxy-ca.pem /app/mitmproxy-conf/mitmproxy-ca.pem
 
-    RUN pip install git+https://github.com/chrisg123/{pkg_name}.git@{branch}
+    COPY export/certs /app/playback/certs
+
+    COPY {playback_context_path} /app/playback/www
 
     EXPOSE 8080
 
-    CMD ["python", "-m", "{pkg_name}", "--playback"]
+    CMD ["python", "-m", "{pkg_name}", "--playback", "--verify", "--fast"]
     """
-    with open("Dockerfile", "w", encoding='utf-8') as f:
+    dockerfile = export_dir / "Dockerfile"
+    with open(dockerfile, "w", encoding='utf-8') as f:
         f.write(dockerfile_content)
 
+    with open(context_dir / ".dockerignore", "w", encoding='utf-8') as f:
+        f.write("\n".join([
+            "*", "!export/wheelhouse", "!export/dist", "!export/certs",
+            "!export/mitmproxy-ca.pem", f"!{playback_context_path}"
+        ]) + "\n")
+
     # Check if Docker is installed
     if not which("docker"):
         print(
@@ -430,9 +1259,12 @@ def export(dev: bool = False):
         return
 
     try:
-        subprocess.run(
-            ["docker", "build", "--no-cache", "-t", image_name, "."],
-            check=True)
+        subprocess.run([
+            "docker", "build", "-f",
+            str(dockerfile), "-t", image_name,
+            str(context_dir)
+        ],
+                       check=True)
         subprocess.run(["docker", "save", "-o", image_tar, image_name],
                        check=True)
 
@@ -440,7 +1272,187 @@ def export(dev: bool = False):
     except subprocess.CalledProcessError as e:
         print(f"Error durring export: {e}")
 
-    docker_image_remove(image_name)
+def export_zipapp():
+    playback_storage_path = get_playback_storage_path()
+    url_to_folder_map_file = get_url_to_folder_map_file(playback_storage_path)
+    if not url_to_folder_map_file.exists():
+        print("Nothing to export. Try running --process first.")
+        return
+
+    with open(url_to_folder_map_file, 'r', encoding='utf-8') as f:
+        url_to_folder_map = json.load(f)
+
+    # Prefer the same CA the docker export ships, fall back to the one
+    # mitmproxy uses locally.
+    certdir = get_pkg_storage_path() / "certificates"
+    ca_file = certdir / "mockasiteCA.pem"
+    if ca_file.exists():
+        store = load_ca_file(ca_file, certdir / "mitmproxy-dhparam.pem")
+    else:
+        confdir = get_mitm_confdir_runtime()
+        confdir.mkdir(parents=True, exist_ok=True)
+        store = load_ca_store(confdir)
+        ca_file = confdir / "mitmproxy-ca.pem"
+
+    cert_dir = get_export_storage_path() / "zipapp-certs"
+    cache_host_certs(url_to_folder_map, cert_dir, store)
+
+    pkg_dir = Path(__file__).resolve().parent
+    modules = [
+        "__init__.py", "utils.py", "shaping.py", "access_log.py",
+        "body_cache.py", "Replayer.py", "standalone.py"
+    ]
+    app_file = Path(f"{get_pkg_name()}_export.pyz")
+
+    with open(app_file, 'wb') as f:
+        f.write(b"#!/usr/bin/env python3\n")
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(
+                "__main__.py", f"import sys\n"
+                f"from {get_pkg_name()}.standalone import main\n"
+                "sys.exit(main())\n")
+            for module in modules:
+                zf.write(pkg_dir / module, f"{get_pkg_name()}/{module}")
+
+            zf.write(ca_file, standalone.CA_FILE)
+            for cert_file in sorted(cert_dir.iterdir()):
+                zf.write(cert_file, f"{standalone.CERT_DIR}/{cert_file.name}")
+
+            for dirpath, _, filenames in os.walk(playback_storage_path):
+                for filename in sorted(filenames):
+                    path = Path(dirpath) / filename
+                    rel_path = path.relative_to(
+                        playback_storage_path).as_posix()
+                    compression = zipfile.ZIP_STORED if is_compressed(
+                        rel_path) else zipfile.ZIP_DEFLATED
+                    zf.write(path, f"{standalone.DATA_DIR}/{rel_path}",
+                             compress_type=compression)
+
+    app_file.chmod(0o755)
+    print(f"Zipapp saved to {app_file}. Run it with" +
+          f" 'python3 {app_file} --port 8080' and use it as an HTTP proxy.")
+
+def export_bundle(incremental: bool = False, skip_compressed: bool = False):
+    playback_storage_path = get_playback_storage_path()
+    if not get_url_to_folder_map_file(playback_storage_path).exists():
+        print("Nothing to bundle. Try running --process first.")
+        return
+
+    state_dir = get_site_storage_path() / "export"
+    state_dir.mkdir(parents=True, exist_ok=True)
+    state_file = state_dir / "bundle.json"
+    previous = None
+    if state_file.exists():
+        with open(state_file, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+
+    manifest = build_manifest(playback_storage_path,
+                              previous["manifest"] if previous else None)
+
+    out_dir = Path(f"{get_pkg_name()}_bundle")
+    description_file = write_bundle(playback_storage_path,
+                                    out_dir,
+                                    manifest,
+                                    previous if incremental else None,
+                                    skip_compressed=skip_compressed)
+    copy(description_file, state_file)
+
+    with open(description_file, 'r', encoding='utf-8') as f:
+        description = json.load(f)
+    print(f"Bundle written to '{description_file}':" +
+          f" {description['files']} files, {description['bytes']} bytes," +
+          f" {len(description['removed'])} removed.")
+
+def get_source_root() -> Optional[Path]:
+    """Returns the project root when running from a source checkout."""
+    root = Path(__file__).resolve().parent.parent
+    return root if (root / "setup.py").exists() else None
+
+def build_local_wheel(source_root: Path, dist_dir: Path) -> Optional[Path]:
+    if dist_dir.exists():
+        rmtree(dist_dir)
+    dist_dir.mkdir(parents=True)
+
+    try:
+        subprocess.run([
+            sys.executable, "-m", "pip", "wheel", "--no-deps", "-q", "-w",
+            str(dist_dir),
+            str(source_root)
+        ],
+                       check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Error building wheel: {e}")
+        return None
+
+    wheels = sorted(dist_dir.glob(f"{get_pkg_name()}-*.whl"))
+    return wheels[0] if wheels else None
+
+def get_wheel_requirements(wheel: Path) -> List[str]:
+    with zipfile.ZipFile(wheel) as zf:
+        metadata_name = next(n for n in zf.namelist()
+                             if n.endswith(".dist-info/METADATA"))
+        metadata = zf.read(metadata_name).decode('utf-8')
+    return [
+        line.split(":", 1)[1].strip()
+        for line in metadata.splitlines()
+        if line.startswith("Requires-Dist:")
+    ]
+
+def pin_requirement(requirement: str) -> str:
+    """
+    Pins a Requires-Dist entry to the version installed here, so the export
+    image runs the versions mockasite was used with instead of whatever the
+    index has on the day of the export.
+    """
+    name, extras, marker = re.match(
+        r"([A-Za-z0-9._-]+)(\[[^\]]*\])?[^;]*(;.*)?",
+        requirement.strip()).groups()
+    try:
+        version = metadata.version(name)
+    except metadata.PackageNotFoundError:
+        print(f"Warning: {name} is not installed, its version is not pinned.")
+        return requirement
+    return f"{name}{extras or ''}=={version}{marker or ''}"
+
+def ensure_wheelhouse(wheel: Path, wheelhouse: Path) -> bool:
+    """
+    Downloads the runtime dependencies of wheel, pinned to the installed
+    versions, for the export image once. Later exports with the same pinned
+    requirements reuse them without network.
+    """
+    requirements = "\n".join(
+        pin_requirement(r) for r in get_wheel_requirements(wheel)) + "\n"
+    requirements_file = wheelhouse / "requirements.txt"
+
+    if requirements_file.exists() and requirements_file.read_text(
+            encoding='utf-8') == requirements:
+        return True
+
+    if wheelhouse.exists():
+        rmtree(wheelhouse)
+    wheelhouse.mkdir(parents=True)
+    download_requirements = wheelhouse / "requirements.in"
+    download_requirements.write_text(requirements, encoding='utf-8')
+
+    machine = platform.machine()
+    platforms = []
+    for tag in EXPORT_MANYLINUX_TAGS:
+        platforms.extend(["--platform", f"{tag}_{machine}"])
+
+    try:
+        subprocess.run([
+            sys.executable, "-m", "pip", "download", "-q", "--dest",
+            str(wheelhouse), "--only-binary=:all:", "--python-version",
+            EXPORT_PYTHON_VERSION
+        ] + platforms + ["-r", str(download_requirements)],
+                       check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Error downloading export dependencies: {e}")
+        return False
+
+    download_requirements.unlink()
+    requirements_file.write_text(requirements, encoding='utf-8')
+    return True
 
 def find_chrome_executable() -> str:
     common_names = ['google-chrome-stable', 'google-chrome', 'chrome']
@@ -449,14 +1461,22 @@ def find_chrome_executable() -> str:
             return name
     raise FileNotFoundError("Google Chrome not found on system.")
 
-def launch_mitmdump(port) -> subprocess.Popen:
+def launch_mitmdump(port, capture_rules: dict,
+                    stats_file: Path) -> subprocess.Popen:
     confdir = str(get_mitm_confdir_runtime())
+    capture_filter = Path(__file__).resolve().parent / "capture_filter.py"
     mitm_cmd = [
         'mitmdump',
         '-p', str(port),
-        '-w', get_last_capture_file(),
+        '-s', str(capture_filter),
+        '--set', f'capture_file={get_last_capture_file()}',
+        '--set', f'capture_stats_file={stats_file}',
         '--set', f'confdir={confdir}'
     ]
+    for name, value in capture_rules.items():
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            mitm_cmd.extend(['--set', f'{name}={v}'])
     return subprocess.Popen(mitm_cmd,
                             stdout=subprocess.DEVNULL,
                             stderr=subprocess.DEVNULL)
@@ -478,23 +1498,111 @@ def get_chrome_cmd(port: int, url: str) -> [str]:
         chrome_cmd.extend([url])
     return chrome_cmd
 
+def get_pool_state_file() -> Path:
+    return get_pkg_storage_path() / POOL_STATE_FILE
+
+def run_browser_pool(size: int):
+    state_file = get_pool_state_file()
+    state = read_pool_state(state_file)
+    if state is not None:
+        print(f"A browser pool is already running [{state['pid']}].")
+        return
+
+    try:
+        chrome = find_chrome_executable()
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        return
+
+    pool = BrowserPool(size, get_pkg_storage_path() / "browser-pool", chrome)
+    # The browsers run in their own sessions, so stop them on SIGTERM too.
+    signal(SIGTERM, lambda s, f: sys.exit(0))
+    try:
+        for instance in pool.start():
+            print(f"Browser {instance.instance_id} did not start.")
+        pool.write_state(state_file)
+        for instance in pool.instances:
+            print(f"Browser {instance.instance_id}: DevTools port" +
+                  f" {instance.devtools_port}, proxy port" +
+                  f" {instance.proxy_port}.")
+        print(f"Browser pool state in '{state_file}'. [{os.getpid()}]",
+              flush=True)
+        pool.watch(state_file)
+    finally:
+        pool.stop()
+        state_file.unlink(missing_ok=True)
+
+def lease_pooled_browser() -> Optional[LeasedBrowser]:
+    """
+    Leases a free instance of the pool with a fresh browser context, or
+    returns None.
+    """
+    if read_pool_state(get_pool_state_file()) is None:
+        print("No browser pool is running. Start one with --browser-pool N.")
+        return None
+    pooled = lease_instance(get_pool_state_file())
+    if pooled is None:
+        print("Every browser of the pool is in use.")
+        return None
+    instance, lease = pooled
+    try:
+        leased = LeasedBrowser(instance, lease)
+    except (OSError, DevToolsError) as e:
+        lease.close()
+        print("Error: Cannot open a browser context in pooled browser" +
+              f" {instance['id']}: {e}")
+        return None
+    print(f"Using pooled browser {instance['id']}, DevTools port" +
+          f" {instance['devtools_port']}.")
+    return leased
+
+def browse_in_pooled_browser(pooled: LeasedBrowser, url: str):
+    """
+    Opens url in a new tab of the pooled browser and waits until it is
+    closed, by automation over DevTools or on Ctrl+C.
+    """
+    target_id = pooled.open_url(url)
+    print("Close the tab to finish (or Ctrl+C).")
+    try:
+        while pooled.is_target_open(target_id):
+            time.sleep(0.5)
+    finally:
+        pooled.close_target(target_id)
+
+def get_pkg_storage_path() -> Path:
+    return Path.home() / f".{get_pkg_name()}"
+
+def get_body_store() -> BodyStore:
+    return BodyStore(get_pkg_storage_path() / "bodies")
+
+def get_export_storage_path() -> Path:
+    export_dir = get_pkg_storage_path() / "export"
+    export_dir.mkdir(parents=True, exist_ok=True)
+    return export_dir
+
 def get_last_capture_file() -> Path:
     return get_capture_storage_path() / "traffic_capture"
 
+def get_site_storage_path(name: Optional[str] = None) -> Path:
+    """
+    The default site lives directly in ~/.mockasite, named sites (--name) in
+    ~/.mockasite/sites/<name>.
+    """
+    name = name or get_site_name()
+    if not name or name == DEFAULT_SITE:
+        return get_pkg_storage_path()
+    return get_pkg_storage_path() / "sites" / name
+
 def get_capture_storage_path() -> Path:
-    home_dir = Path.home()
-    pkg_dir = home_dir / f".{get_pkg_name()}"
-    captures_dir = pkg_dir / "captures"
+    captures_dir = get_site_storage_path() / "captures"
     captures_dir.mkdir(parents=True, exist_ok=True)
     return captures_dir
 
-def get_playback_storage_path() -> Path:
+def get_playback_storage_path(name: Optional[str] = None) -> Path:
     if is_docker():
         return Path("/") / "app" / "playback" / "www"
 
-    home_dir = Path.home()
-    pkg_dir = home_dir / f".{get_pkg_name()}"
-    playback_dir = pkg_dir / "playback" / "www"
+    playback_dir = get_site_storage_path(name) / "playback" / "www"
     mkdir_p(playback_dir, get_effective_user())
     return playback_dir
 
@@ -522,23 +1630,95 @@ def normalize_meta(meta):
     }
     return json.dumps(normalized_meta, indent=4, sort_keys=True)
 
-def format_js_file(file_path):
-    try:
-        subprocess.run(["prettier", "--write", file_path], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error formatting file {file_path}: {e}")
+def get_flow_timing(flow) -> Optional[dict]:
+    """
+    Time to first byte and body transfer time of a recorded response in
+    seconds, plus the size on the wire, for shaped playback.
+    """
+    request, response = flow.request, flow.response
+    if None in (request.timestamp_start, response.timestamp_start,
+                response.timestamp_end):
+        return None
+    return {
+        "ttfb": round(max(response.timestamp_start - request.timestamp_start,
+                          0.0), 6),
+        "duration": round(max(response.timestamp_end -
+                              response.timestamp_start, 0.0), 6),
+        "size": len(response.raw_content or b'')
+    }
+
+def get_recorded_chunks(flow) -> Optional[list]:
+    """
+    Returns [[size, gap], ...] for responses that streamed, where gap is the
+    number of seconds since the previous chunk (or the response headers).
+    Returns None for responses that are better replayed in one piece.
+    """
+    recorded = flow.metadata.get("capture_chunks")
+    if not recorded:
+        return None
+
+    content_type = flow.response.headers.get("Content-Type", "")
+    content_type = content_type.split(';', 1)[0].strip().lower()
+
+    chunks, previous, remaining = [], 0.0, len(flow.response.raw_content
+                                               or b'')
+    for size, offset in recorded:
+        if remaining <= 0: break
+        size = min(size, remaining)
+        chunks.append([size, round(max(offset - previous, 0.0), 6)])
+        previous = offset
+        remaining -= size
+
+    if content_type in STREAM_CONTENT_TYPES:
+        return chunks
+    if len(chunks) > 1 and max(gap for _, gap in chunks[1:]) >= STREAM_GAP_THRESHOLD:
+        return chunks
+    return None
 
 def hash_path(path):
     return hashlib.md5(path.encode()).hexdigest()
 
-def process_capture():
+def set_memory_limit(limit_mb: int):
+    """
+    Caps the data segment of this process so an oversized flow fails with a
+    MemoryError instead of pushing the machine into swap or the OOM killer.
+    """
+    limit = limit_mb * 1024 * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+
+def process_capture(memory_limit_mb: int = 0,
+                    ignore_body_fields: Optional[List[str]] = None,
+                    delta: bool = False,
+                    transforms: Optional[List[str]] = None,
+                    transform_options: Optional[dict] = None):
+    """
+    With delta, the capture is processed into a fresh tree that replaces the
+    previous one once complete, and the differences are reported.
+    """
     last_capture_file = get_last_capture_file()
     if not os.path.exists(last_capture_file):
         print("Run a capture first.")
         return
 
+    if memory_limit_mb:
+        set_memory_limit(memory_limit_mb)
+
     base_dir = get_playback_storage_path()
-    max_path_length = 255
+    body_store = get_body_store()
+
+    if delta:
+        previous_index = load_processed_index(base_dir)
+        if previous_index is None:
+            print("No previous processed index, every response is new.")
+            previous_index = {"keys": {}}
+        processed_dir = base_dir
+        base_dir = processed_dir.with_name(f"{processed_dir.name}.new")
+        if base_dir.exists():
+            rmtree(base_dir)
+        mkdir_p(base_dir, get_effective_user())
 
     playback_metadata_path = get_capture_storage_path(
     ) / "playback_metadata.json"
@@ -547,125 +1727,261 @@ def process_capture():
 
     url_to_folder_map_file = base_dir / "url_to_folder_map.json"
     url_to_folder_map = {}
+    # sha256 of every body written, so duplicates never re-read files
+    body_digests = {}
+    skipped_flows = 0
+    ignore_body_fields = sorted(set(ignore_body_fields or []))
+    # base map key -> body fingerprint -> map keys recorded for that body
+    fingerprints = {}
+    # map key -> host, status, content type, size and digest of the body
+    processed_index = {}
 
     with open(last_capture_file, 'rb') as f:
-        reader = FlowReader(f)
-        for flow in reader.stream():
+        for flow in iter_capture_flows(f):
+            if flow is None:
+                skipped_flows += 1
+                print("Skip a flow that does not fit into the memory limit.")
+                continue
+
             flow_type = str(type(flow))
 
             if "HTTPFlow" not in flow_type: continue
 
-            origin_header = flow.request.headers.get("Origin", "no_origin")
-            http_method = flow.request.method.upper()
-            parsed_url = urlparse(flow.request.pretty_url)
-            query_params = flow.request.query.keys()
-
-            mapKey = generate_map_key(http_method, parsed_url.path,
-                                      query_params, origin_header)
-
-            _, _, query_param_hash, origin_hash, _ = split_map_key(mapKey)
-
-            directory_path = os.path.join(
-                base_dir, parsed_url.netloc,
-                os.path.dirname(parsed_url.path.lstrip("/")))
-
-            if len(directory_path) > max_path_length:
-                hashed_path = hash_path(parsed_url.path.lstrip("/"))
-                directory_path = os.path.join(base_dir, parsed_url.netloc,
-                                              hashed_path)
-
-            os.makedirs(directory_path, exist_ok=True)
-
-            file_name = os.path.basename(parsed_url.path)
-
-            meta_path = os.path.join(
-                directory_path,
-                f"{http_method}.META.{origin_hash}.{query_param_hash}.{file_name}.json"
-            )
-
-            if len(meta_path) > max_path_length:
-                meta_path = os.path.join(
-                    directory_path,
-                    f"{http_method}.META.{origin_hash}.{query_param_hash}.{hash_path(file_name)}.json"
-                )
-
-            body_path = os.path.join(
-                directory_path,
-                f"{http_method}.BODY.{origin_hash}.{query_param_hash}.{file_name}"
-            )
-
-            if len(body_path) > max_path_length:
-                body_path = os.path.join(
-                    directory_path,
-                    f"{http_method}.BODY.{origin_hash}.{query_param_hash}.{hash_path(file_name)}.json"
-                )
-
-            if mapKey in url_to_folder_map:
-                rel_meta_path, rel_body_path = url_to_folder_map[mapKey]
-
-                meta_path = os.path.join(base_dir, rel_meta_path)
-                body_path = os.path.join(base_dir, rel_body_path)
-
-                existing_meta = None
-                with open(meta_path, 'r', encoding='utf-8') as meta_file:
-                    existing_meta = json.load(meta_file)
-                    existing_meta_hash = hashlib.sha256(
-                        normalize_meta(existing_meta).encode()).hexdigest()
-
-                with open(body_path, 'rb') as body_file:
-                    existing_body_hash = hashlib.sha256(
-                        body_file.read()).hexdigest()
-
-                hasResponse = flow.response is not None
-
-                if hasResponse:
-                    current_meta = {
-                        "status_code": flow.response.status_code,
-                        "headers": dict(flow.response.headers)
-                    }
-                    normalized_current_meta = normalize_meta(current_meta)
-                    current_meta_hash = hashlib.sha256(
-                        normalized_current_meta.encode()).hexdigest()
-                    current_body_hash = hashlib.sha256(
-                        flow.response.content).hexdigest()
-
-                    if existing_meta_hash == current_meta_hash and existing_body_hash == current_body_hash:
-                        # The response is a duplicate, so skip further processing
-                        continue
-
-                mapKey = get_next_available_map_key(mapKey, url_to_folder_map,
-                                                    query_params,
-                                                    origin_header)
-                _, _, _, _, sequence_number = split_map_key(mapKey)
-
-                if not hasResponse:
-                    url_to_folder_map[mapKey] = None
-                    continue
-
-                meta_path = insert_sequence_number_in_path(
-                    meta_path, sequence_number, query_param_hash)
-                body_path = insert_sequence_number_in_path(
-                    body_path, sequence_number, query_param_hash)
-
-            if flow.response:
-                response_data = {
-                    "status_code": flow.response.status_code,
-                    "headers": dict(flow.response.headers)
-                }
-                with open(meta_path, 'w', encoding='utf-8') as meta_file:
-                    json.dump(response_data, meta_file, indent=4)
+            try:
+                map_key = process_flow(flow, base_dir, url_to_folder_map,
+                                       body_digests, processed_index,
+                                       body_store)
+                if map_key is not None:
+                    index_body_fingerprint(flow, map_key, fingerprints,
+                                           ignore_body_fields)
+            except MemoryError:
+                skipped_flows += 1
+                print(f"Skip '{flow.request.pretty_url}': it does not fit" +
+                      " into the memory limit.")
+
+    if skipped_flows:
+        print(f"{skipped_flows} flows were skipped.")
+
+    with open(url_to_folder_map_file, 'w', encoding='utf-8') as map_file:
+        json.dump(url_to_folder_map, map_file, indent=4)
+
+    with open(base_dir / BODY_FINGERPRINT_INDEX_FILE, 'w',
+              encoding='utf-8') as index_file:
+        json.dump({
+            "ignore_fields": ignore_body_fields,
+            "keys": fingerprints
+        },
+                  index_file,
+                  indent=4)
+
+    if transforms:
+        stats = run_transforms(transforms, transform_options or {}, base_dir,
+                               url_to_folder_map, processed_index, body_store,
+                               get_pkg_storage_path() / TRANSFORM_CACHE_FILE)
+        print(f"Transformed {stats['transformed']} bodies," +
+              f" {stats['cached']} from cache, {stats['failed']} failed.")
+
+    write_processed_index(base_dir, processed_index)
+
+    write_integrity_manifest(
+        base_dir, [
+            rel_path for paths in url_to_folder_map.values() if paths
+            for rel_path in paths
+        ] + [
+            url_to_folder_map_file.name, BODY_FINGERPRINT_INDEX_FILE,
+            PROCESSED_INDEX_FILE, playback_metadata_path.name
+        ], {
+            url_to_folder_map[map_key][1]: entry["sha256"]
+            for map_key, entry in processed_index.items()
+        })
+
+    if delta:
+        replace_processed_dir(base_dir, processed_dir)
+        changes = diff_processed_indexes(previous_index,
+                                         {"keys": processed_index})
+        with open(processed_dir.parent / CHANGE_REPORT_FILE,
+                  'w',
+                  encoding='utf-8') as f:
+            json.dump(changes, f, indent=4)
+        print_changes(changes)
+        body_store.prune()
+
+    print(f"Wrote {body_store.added} new bodies" +
+          f" ({body_store.added_bytes} bytes), reused {body_store.reused}" +
+          f" ({body_store.reused_bytes} bytes).")
+
+    cache_host_certs(url_to_folder_map, get_host_cert_dir())
+
+def replace_processed_dir(new_dir: Path, processed_dir: Path):
+    """Swaps new_dir in for processed_dir and removes the old tree."""
+    old_dir = processed_dir.with_name(f"{processed_dir.name}.old")
+    if old_dir.exists():
+        rmtree(old_dir)
+    os.rename(processed_dir, old_dir)
+    os.rename(new_dir, processed_dir)
+    rmtree(old_dir)
+
+def index_body_fingerprint(flow, map_key: str, fingerprints: dict,
+                           ignore_body_fields: List[str]):
+    fingerprint = body_fingerprint(flow.request.get_content(strict=False),
+                                   flow.request.headers.get("Content-Type"),
+                                   ignore_body_fields)
+    if fingerprint is None:
+        return
+    map_keys = fingerprints.setdefault(get_base_map_key(map_key),
+                                       {}).setdefault(fingerprint, [])
+    if map_key not in map_keys:
+        map_keys.append(map_key)
+
+def process_flow(flow,
+                 base_dir: Path,
+                 url_to_folder_map: dict,
+                 body_digests: dict,
+                 processed_index: Optional[dict] = None,
+                 body_store: Optional[BodyStore] = None) -> Optional[str]:
+    """
+    Writes the META and BODY files for one flow and records them in
+    url_to_folder_map. The body is decoded and hashed chunk by chunk first
+    and only written when it is new: duplicates of an already recorded
+    response are discarded and bodies the store has are linked.
+    Returns the map key that answers the flow, or None if nothing was stored.
+    """
+    max_path_length = 255
 
-                rel_meta_path = os.path.relpath(meta_path, base_dir)
-                rel_body_path = os.path.relpath(body_path, base_dir)
+    origin_header = flow.request.headers.get("Origin", "no_origin")
+    http_method = flow.request.method.upper()
+    parsed_url = urlparse(flow.request.pretty_url)
+    query_params = flow.request.query.keys()
 
-                if flow.response.content is not None:
-                    with open(body_path, 'wb') as body_file:
-                        body_file.write(flow.response.content)
-                else:
-                    with open(body_path, 'wb') as body_file:
-                        pass # Creates empty file
+    mapKey = generate_map_key(http_method, parsed_url.path,
+                              query_params, origin_header)
 
-                url_to_folder_map[mapKey] = [rel_meta_path, rel_body_path]
+    _, _, query_param_hash, origin_hash, _ = split_map_key(mapKey)
 
-    with open(url_to_folder_map_file, 'w', encoding='utf-8') as map_file:
-        json.dump(url_to_folder_map, map_file, indent=4)
+    directory_path = os.path.join(
+        base_dir, parsed_url.netloc,
+        os.path.dirname(parsed_url.path.lstrip("/")))
+
+    if len(directory_path) > max_path_length:
+        hashed_path = hash_path(parsed_url.path.lstrip("/"))
+        directory_path = os.path.join(base_dir, parsed_url.netloc,
+                                      hashed_path)
+
+    os.makedirs(directory_path, exist_ok=True)
+
+    file_name = os.path.basename(parsed_url.path)
+
+    meta_path = os.path.join(
+        directory_path,
+        f"{http_method}.META.{origin_hash}.{query_param_hash}.{file_name}.json"
+    )
+
+    if len(meta_path) > max_path_length:
+        meta_path = os.path.join(
+            directory_path,
+            f"{http_method}.META.{origin_hash}.{query_param_hash}.{hash_path(file_name)}.json"
+        )
+
+    body_path = os.path.join(
+        directory_path,
+        f"{http_method}.BODY.{origin_hash}.{query_param_hash}.{file_name}"
+    )
+
+    if len(body_path) > max_path_length:
+        body_path = os.path.join(
+            directory_path,
+            f"{http_method}.BODY.{origin_hash}.{query_param_hash}.{hash_path(file_name)}.json"
+        )
+
+    hasResponse = flow.response is not None
+    tmp_body_path = f"{body_path}.tmp"
+    current_body_hash = None
+    # The body is written to tmp_body_path first and moved into place once
+    # the flow is stored; whatever happens before that, it must not be left
+    # behind in the tree.
+    try:
+        if hasResponse:
+            current_body_hash = response_body_sha256(flow.response)
+
+        if url_to_folder_map.get(mapKey) is not None:
+            rel_meta_path, rel_body_path = url_to_folder_map[mapKey]
+
+            meta_path = os.path.join(base_dir, rel_meta_path)
+            body_path = os.path.join(base_dir, rel_body_path)
+
+            existing_meta = None
+            with open(meta_path, 'r', encoding='utf-8') as meta_file:
+                existing_meta = json.load(meta_file)
+                existing_meta_hash = hashlib.sha256(
+                    normalize_meta(existing_meta).encode()).hexdigest()
+
+            existing_body_hash = body_digests.get(mapKey)
+            if existing_body_hash is None:
+                existing_body_hash = file_sha256(Path(body_path))
+
+            if hasResponse:
+                current_meta = {
+                    "status_code": flow.response.status_code,
+                    "headers": dict(flow.response.headers)
+                }
+                normalized_current_meta = normalize_meta(current_meta)
+                current_meta_hash = hashlib.sha256(
+                    normalized_current_meta.encode()).hexdigest()
+
+                if existing_meta_hash == current_meta_hash and existing_body_hash == current_body_hash:
+                    # The response is a duplicate, so skip further processing
+                    return mapKey
+
+        if mapKey in url_to_folder_map:
+            mapKey = get_next_available_map_key(mapKey, url_to_folder_map,
+                                                query_params,
+                                                origin_header)
+            _, _, _, _, sequence_number = split_map_key(mapKey)
+
+            if not hasResponse:
+                url_to_folder_map[mapKey] = None
+                return None
+
+            meta_path = insert_sequence_number_in_path(
+                meta_path, sequence_number, query_param_hash)
+            body_path = insert_sequence_number_in_path(
+                body_path, sequence_number, query_param_hash)
+
+        if flow.response:
+            response_data = {
+                "status_code": flow.response.status_code,
+                "headers": dict(flow.response.headers),
+                "body_sha256": current_body_hash
+            }
+            timing = get_flow_timing(flow)
+            if timing:
+                response_data["timing"] = timing
+            chunks = get_recorded_chunks(flow)
+            if chunks:
+                response_data["chunks"] = chunks
+            with open(meta_path, 'w', encoding='utf-8') as meta_file:
+                json.dump(response_data, meta_file, indent=4)
+
+            rel_meta_path = os.path.relpath(meta_path, base_dir)
+            rel_body_path = os.path.relpath(body_path, base_dir)
+
+            if body_store is None:
+                write_response_body(flow.response, tmp_body_path)
+                os.replace(tmp_body_path, body_path)
+            elif not body_store.reuse(current_body_hash, body_path):
+                write_response_body(flow.response, tmp_body_path)
+                body_store.store(tmp_body_path, current_body_hash, body_path)
+            body_digests[mapKey] = current_body_hash
+            if processed_index is not None:
+                processed_index[mapKey] = index_entry(
+                    flow.request.pretty_host, flow.response.status_code,
+                    get_content_type(flow.response.headers),
+                    os.path.getsize(body_path), current_body_hash)
+
+            url_to_folder_map[mapKey] = [rel_meta_path, rel_body_path]
+            return mapKey
+
+        return None
+    finally:
+        if os.path.lexists(tmp_body_path):
+            os.remove(tmp_body_path)
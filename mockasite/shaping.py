@@ -0,0 +1,80 @@
+from typing import Optional
+
+# name: (latency in seconds, throughput in bytes per second), modelled on
+# the Chrome DevTools throttling presets.
+NETWORK_PROFILES = {
+    "slow-3g": (2.0, 50_000),
+    "3g": (0.5625, 180_000),
+    "4g": (0.15, 1_125_000),
+    "dsl": (0.05, 250_000),
+}
+
+SHAPING_MODES = ["off", "recorded", "scaled:<factor>"] + list(NETWORK_PROFILES)
+
+class Shaper:
+    """
+    Turns the timing recorded for a response into the delay playback should
+    apply before answering.
+
+      off             -- no delay
+      recorded        -- recorded time to first byte plus transfer time
+      scaled:<factor> -- recorded timing multiplied by factor
+      <profile>       -- fixed latency plus size / throughput of a profile
+    """
+
+    def __init__(self, mode: str = "off", factor: float = 1.0,
+                 profile: Optional[str] = None):
+        self.mode = mode
+        self.factor = factor
+        self.profile = profile
+
+    @classmethod
+    def parse(cls, spec: Optional[str]) -> "Shaper":
+        spec = (spec or "off").strip().lower()
+        if spec in ("off", "recorded"):
+            return cls(spec)
+        if spec.startswith("scaled:"):
+            try:
+                factor = float(spec.split(":", 1)[1])
+            except ValueError as e:
+                raise ValueError(f"Invalid scale factor in '{spec}'.") from e
+            return cls("scaled", factor=factor)
+        if spec in NETWORK_PROFILES:
+            return cls("profile", profile=spec)
+        raise ValueError(f"Unknown shaping mode '{spec}'. Choose one of:" +
+                         f" {', '.join(SHAPING_MODES)}.")
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def delay(self, timing: Optional[dict], size: int) -> float:
+        """Returns the delay in seconds for a response of size bytes."""
+        if self.mode == "off":
+            return 0.0
+
+        if self.mode == "profile":
+            latency, throughput = NETWORK_PROFILES[self.profile]
+            if timing and timing.get("size") is not None:
+                size = timing["size"]
+            return latency + size / throughput
+
+        if not timing:
+            return 0.0
+        recorded = (timing.get("ttfb") or 0.0) + (timing.get("duration")
+                                                  or 0.0)
+        if self.mode == "scaled":
+            return recorded * self.factor
+        return recorded
+
+    def chunk_delay(self, gap: float, size: int) -> float:
+        """
+        Returns the pause before a chunk of a streamed response. Recorded gaps
+        are always kept, they are part of how the stream behaves.
+        """
+        if self.mode == "scaled":
+            return gap * self.factor
+        if self.mode == "profile":
+            _, throughput = NETWORK_PROFILES[self.profile]
+            return max(gap, size / throughput)
+        return gap
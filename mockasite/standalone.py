@@ -0,0 +1,236 @@
+import os
+import sys
+import ssl
+import json
+import socket
+import argparse
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+from .Replayer import Replayer, StreamedBody
+from .shaping import Shaper, SHAPING_MODES
+from .access_log import AccessLog, LOG_LEVELS
+
+DATA_DIR = "www"
+CERT_DIR = "certs"
+CA_FILE = "mitmproxy-ca.pem"
+
+class PlaybackProxyHandler(BaseHTTPRequestHandler):
+    """
+    Dependency free playback proxy used by the zipapp export. CONNECT
+    tunnels are terminated with the pre-generated leaf certificates, so only
+    the standard library is needed at runtime.
+    """
+    protocol_version = "HTTP/1.1"
+
+    # Set on the subclass created by serve().
+    replayer: Replayer = None
+    tls_contexts: dict = {}
+
+    def do_CONNECT(self):
+        host = self.path.rsplit(':', 1)[0].strip('[]')
+        context = self.tls_contexts.get(host)
+        if context is None:
+            self.send_error(502, f"No recorded certificate for '{host}'")
+            return
+
+        self.send_response(200, "Connection established")
+        self.end_headers()
+
+        try:
+            tls_connection = context.wrap_socket(self.connection,
+                                                 server_side=True)
+        except (ssl.SSLError, OSError):
+            self.close_connection = True
+            return
+
+        self.connection = tls_connection
+        self.rfile = tls_connection.makefile('rb', self.rbufsize)
+        self.wfile = tls_connection.makefile('wb', self.wbufsize)
+        self.close_connection = False
+        try:
+            while not self.close_connection:
+                self.handle_one_request()
+        except (ssl.SSLError, ConnectionError):
+            self.close_connection = True
+
+    def replay(self):
+        http_method = self.command.upper()
+        parsed_url = urlparse(self.path)
+        origin_header = self.headers.get("Origin", "no_origin")
+        query_params = dict.fromkeys(
+            k for k, _ in parse_qsl(parsed_url.query, keep_blank_values=True))
+
+        content_length = int(self.headers.get("Content-Length", 0) or 0)
+        request_body = self.rfile.read(content_length) if content_length else b''
+
+        status_code, headers, body, delay = self.replayer.replay(
+            http_method, parsed_url.path or '/', query_params, origin_header,
+            request_body, self.headers.get("Content-Type"),
+            self.headers.get("Host") or parsed_url.netloc)
+        headers = self.replayer.add_cors_headers(headers, http_method,
+                                                 self.headers)
+
+        # Every connection has its own thread here, so sleeping only holds
+        # up the response it belongs to.
+        if delay > 0:
+            time.sleep(delay)
+
+        self.send_response(status_code)
+        for key, value in headers.items():
+            if key.lower() in ('connection', 'transfer-encoding'): continue
+            self.send_header(key, value)
+
+        if isinstance(body, StreamedBody):
+            self.send_stream(body, http_method)
+            return
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if http_method != 'HEAD':
+            self.wfile.write(body)
+
+    def send_stream(self, body: StreamedBody, http_method: str):
+        """
+        Writes a recorded stream chunk by chunk, pausing as recorded.
+        HTTP/1.0 clients get the body delimited by closing the connection.
+        """
+        chunked = self.request_version != "HTTP/1.0"
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        self.end_headers()
+        if http_method == 'HEAD':
+            return
+
+        for delay, data in body:
+            if delay > 0:
+                time.sleep(delay)
+            if chunked:
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data +
+                                 b"\r\n")
+            else:
+                self.wfile.write(data)
+            self.wfile.flush()
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = replay
+    do_HEAD = replay
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+def load_tls_contexts(cert_dir: Path, ca_file: Path) -> dict:
+    """
+    Builds one server side SSL context per host. The cached leaf files only
+    hold the certificate; the key is the CA key, see certificates.py.
+    """
+    contexts = {}
+    index_file = cert_dir / "index.json"
+    if not index_file.exists():
+        return contexts
+
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+
+    for host, entry in index["hosts"].items():
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.set_alpn_protocols(["http/1.1"])
+        context.load_cert_chain(cert_dir / entry["file"], keyfile=ca_file)
+        contexts[host] = context
+    return contexts
+
+def extract_certs(archive: zipfile.ZipFile, dest: Path) -> Path:
+    """ssl can only load certificates from disk, so unpack them first."""
+    for name in archive.namelist():
+        if name.startswith(f"{CERT_DIR}/") or name == CA_FILE:
+            archive.extract(name, dest)
+    return dest
+
+def get_archive_path() -> Path:
+    # .../app.pyz/mockasite/standalone.py
+    return Path(__file__).resolve().parent.parent
+
+def serve(url_to_folder_map_file, cert_dir: Path, ca_file: Path,
+          binding: str, port: int, shaper: Shaper, access_log: AccessLog):
+    metadata_file = url_to_folder_map_file.parent / "playback_metadata.json"
+    with metadata_file.open('r', encoding='utf-8') as f:
+        entry_url = json.load(f)["url"]
+
+    handler = type("Handler", (PlaybackProxyHandler, ), {
+        "replayer": Replayer(url_to_folder_map_file, entry_url, shaper,
+                             access_log),
+        "tls_contexts": load_tls_contexts(cert_dir, ca_file)
+    })
+
+    server = ThreadingHTTPServer((binding, port), handler)
+    server.daemon_threads = True
+    print(f"Serving playback proxy binding={binding}, port={port}." +
+          f" [{os.getpid()}]",
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a recorded mock website as an HTTP proxy.")
+    parser.add_argument('--bind', default='0.0.0.0', help='Address to bind.')
+    parser.add_argument('--port', type=int, default=8080, help='Proxy port.')
+    parser.add_argument('--shaping',
+                        default='off',
+                        metavar='MODE',
+                        help='Delay responses to emulate network timing: ' +
+                        ', '.join(SHAPING_MODES) + '.')
+    parser.add_argument('--access-log',
+                        default='-',
+                        metavar='PATH',
+                        help='Append the JSON lines access log to PATH.')
+    parser.add_argument('--log-level',
+                        choices=list(LOG_LEVELS),
+                        default='info',
+                        help='Access log level.')
+    parser.add_argument('--log-sample',
+                        type=float,
+                        default=1.0,
+                        metavar='RATE',
+                        help='Fraction of hits that are logged (0 to 1).')
+    args = parser.parse_args()
+
+    try:
+        shaper = Shaper.parse(args.shaping)
+        access_log = AccessLog(args.access_log, args.log_level,
+                               args.log_sample)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+
+    archive_path = get_archive_path()
+    if not zipfile.is_zipfile(archive_path):
+        print(f"'{archive_path}' is not a zipapp export.")
+        return 1
+
+    with zipfile.ZipFile(archive_path) as archive, \
+            tempfile.TemporaryDirectory() as tmp:
+        extract_certs(archive, Path(tmp))
+        map_file = zipfile.Path(archive, f"{DATA_DIR}/url_to_folder_map.json")
+        try:
+            serve(map_file,
+                  Path(tmp) / CERT_DIR,
+                  Path(tmp) / CA_FILE, args.bind, args.port, shaper,
+                  access_log)
+        except socket.error as e:
+            print(f"Error: {e}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
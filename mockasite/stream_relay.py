@@ -0,0 +1,81 @@
+import time
+import uuid
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from .Replayer import StreamedBody
+
+class StreamRelay:
+    """
+    Loopback server for recorded streams in single-process playback.
+
+    mitmproxy sends a response made by an addon in one piece, so
+    PlaybackAddon parks a StreamedBody here and forwards the request to it
+    instead. The relay writes the chunks with their recorded pauses and the
+    proxy passes them on as they arrive, so only a chunk per stream is in
+    memory, as with the split-mode MockServer.
+    """
+
+    def __init__(self):
+        self.responses: Dict[str, Tuple[int, dict, StreamedBody]] = {}
+        self.lock = threading.Lock()
+        handler = type("Handler", (StreamRelayHandler, ), {"relay": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         name="stream-relay",
+                         daemon=True).start()
+
+    def park(self, status_code: int, headers: dict,
+             body: StreamedBody) -> str:
+        """Returns the path that serves the response once."""
+        path = f"/{uuid.uuid4().hex}"
+        with self.lock:
+            self.responses[path] = (status_code, headers, body)
+        return path
+
+    def take(self, path: str) -> Optional[Tuple[int, dict, StreamedBody]]:
+        with self.lock:
+            return self.responses.pop(path, None)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class StreamRelayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Set on the subclass created by StreamRelay.
+    relay: StreamRelay = None
+
+    def relay_stream(self):
+        response = self.relay.take(self.path)
+        if response is None:
+            self.send_error(404)
+            return
+        status_code, headers, body = response
+
+        self.send_response(status_code)
+        for key, value in headers.items():
+            if key.lower() in ('connection', 'transfer-encoding',
+                               'content-length'):
+                continue
+            self.send_header(key, value)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        for delay, data in body:
+            if delay > 0:
+                time.sleep(delay)
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = relay_stream
+    do_HEAD = relay_stream
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
@@ -0,0 +1,148 @@
+import io
+import zlib
+import hashlib
+from pathlib import Path
+from typing import Iterator, Optional, BinaryIO
+import brotli
+import zstandard
+from mitmproxy.io import FlowReader
+
+# Upper bound for a single decoded chunk held in memory while processing.
+BODY_CHUNK_SIZE = 1024 * 1024
+
+# brotli cannot cap its output per call, so feed it small inputs instead.
+BROTLI_INPUT_CHUNK_SIZE = 64 * 1024
+
+class BodyDecodeError(ValueError):
+    pass
+
+def iter_slices(data, chunk_size: int) -> Iterator[memoryview]:
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+def iter_zlib(raw: bytes, wbits: int, chunk_size: int) -> Iterator[bytes]:
+    decoder = zlib.decompressobj(wbits)
+    for chunk in iter_slices(raw, chunk_size):
+        data = chunk
+        while data:
+            out = decoder.decompress(data, chunk_size)
+            if out:
+                yield out
+            data = decoder.unconsumed_tail
+    tail = decoder.flush()
+    if tail:
+        yield tail
+
+def iter_zstd(raw: bytes, chunk_size: int) -> Iterator[bytes]:
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(raw))
+    while chunk := reader.read(chunk_size):
+        yield chunk
+
+def iter_brotli(raw: bytes) -> Iterator[bytes]:
+    decoder = brotli.Decompressor()
+    for chunk in iter_slices(raw, BROTLI_INPUT_CHUNK_SIZE):
+        out = decoder.process(bytes(chunk))
+        if out:
+            yield out
+
+def is_zlib_stream(raw: bytes) -> bool:
+    return len(raw) >= 2 and (raw[0] & 0x0f) == 8 and (
+        (raw[0] << 8) | raw[1]) % 31 == 0
+
+def iter_decoded_body(raw: bytes,
+                      content_encoding: str,
+                      chunk_size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yields the decoded body in chunks of at most roughly chunk_size bytes
+    without materializing the whole decoded body. Supports the same
+    encodings mitmproxy decodes.
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    try:
+        if encoding in ("", "identity", "none"):
+            yield from iter_slices(raw, chunk_size)
+        elif encoding in ("gzip", "x-gzip"):
+            yield from iter_zlib(raw, 16 + zlib.MAX_WBITS, chunk_size)
+        elif encoding == "deflate":
+            wbits = zlib.MAX_WBITS if is_zlib_stream(raw) else -zlib.MAX_WBITS
+            yield from iter_zlib(raw, wbits, chunk_size)
+        elif encoding == "deflateraw":
+            yield from iter_zlib(raw, -zlib.MAX_WBITS, chunk_size)
+        elif encoding == "zstd":
+            yield from iter_zstd(raw, chunk_size)
+        elif encoding == "br":
+            yield from iter_brotli(raw)
+        else:
+            raise BodyDecodeError(f"Unsupported content encoding: {encoding}")
+    except (zlib.error, brotli.error, zstandard.ZstdError) as e:
+        raise BodyDecodeError(str(e)) from e
+
+def write_chunks(chunks, path: Path) -> str:
+    """Writes chunks to path and returns their sha256 from the same pass."""
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+def hash_chunks(chunks) -> str:
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def response_body_sha256(response, chunk_size: int = BODY_CHUNK_SIZE) -> str:
+    """
+    The sha256 of the body write_response_body() would write, computed chunk
+    by chunk without writing anything.
+    """
+    raw = response.raw_content or b''
+    try:
+        return hash_chunks(
+            iter_decoded_body(raw, response.headers.get("Content-Encoding"),
+                              chunk_size))
+    except BodyDecodeError:
+        return hash_chunks(iter_slices(raw, chunk_size))
+
+def write_response_body(response, path: Path,
+                        chunk_size: int = BODY_CHUNK_SIZE) -> str:
+    """
+    Decodes a mitmproxy response body into path chunk by chunk and returns
+    its sha256. Bodies that fail to decode are written as received, which
+    matches mitmproxy's non-strict get_content().
+    """
+    raw = response.raw_content or b''
+    try:
+        return write_chunks(
+            iter_decoded_body(raw, response.headers.get("Content-Encoding"),
+                              chunk_size), path)
+    except BodyDecodeError:
+        return write_chunks(iter_slices(raw, chunk_size), path)
+
+def skip_tnetstring(fo: BinaryIO, start: int):
+    """Moves fo past the tnetstring record that begins at start."""
+    fo.seek(start)
+    length = b""
+    while (c := fo.read(1)).isdigit():
+        length += c
+    fo.seek(int(length) + 1, io.SEEK_CUR)
+
+def iter_capture_flows(fo: BinaryIO) -> Iterator[Optional[object]]:
+    """
+    Yields the flows of a capture file one at a time. A flow that does not
+    fit into memory is skipped and reported by yielding None, reading then
+    resumes with the next record.
+    """
+    while True:
+        start = fo.tell()
+        try:
+            flow = next(iter(FlowReader(fo).stream()), None)
+        except MemoryError:
+            skip_tnetstring(fo, start)
+            yield None
+            continue
+        if flow is None:
+            return
+        yield flow
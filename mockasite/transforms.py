@@ -0,0 +1,330 @@
+import os
+import json
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from .body_store import BodyStore
+
+# Maps "<transform cache key>:<input sha256>" to the output sha256.
+TRANSFORM_CACHE_FILE = "transform_cache.json"
+
+TEXT_CONTENT_TYPES = {
+    "text/html", "text/css", "text/javascript", "application/javascript",
+    "application/x-javascript", "application/json", "application/xml",
+    "text/xml", "image/svg+xml", "text/plain"
+}
+
+PRETTIER_PARSERS = {
+    "text/javascript": "babel",
+    "application/javascript": "babel",
+    "application/x-javascript": "babel",
+    "text/css": "css"
+}
+
+# Runs in one long-lived node process and formats the sources it is sent as
+# JSON lines, answering each with its id so requests can be pipelined.
+PRETTIER_WORKER_SCRIPT = r"""
+const readline = require('readline');
+let prettier;
+try {
+    prettier = require('prettier');
+} catch (e) {
+    process.stdout.write(JSON.stringify({error: String(e.message)}) + '\n');
+    process.exit(1);
+}
+process.stdout.write(JSON.stringify({ready: true}) + '\n');
+readline.createInterface({input: process.stdin}).on('line', async (line) => {
+    const {id, source, parser} = JSON.parse(line);
+    let answer;
+    try {
+        answer = {id, output: await prettier.format(source, {parser})};
+    } catch (e) {
+        answer = {id, error: String(e.message || e)};
+    }
+    process.stdout.write(JSON.stringify(answer) + '\n');
+});
+"""
+
+class TransformError(Exception):
+    pass
+
+class PrettierWorker:
+    """
+    One persistent prettier process shared by all transform threads, instead
+    of spawning prettier per file. Requests are written as they come and
+    matched to their answers by id.
+    """
+
+    def __init__(self):
+        env = dict(os.environ)
+        try:
+            global_modules = subprocess.run(["npm", "root", "-g"],
+                                            capture_output=True,
+                                            text=True,
+                                            check=True).stdout.strip()
+            env["NODE_PATH"] = os.pathsep.join(
+                filter(None, [env.get("NODE_PATH"), global_modules]))
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+        try:
+            self.process = subprocess.Popen(
+                ["node", "-e", PRETTIER_WORKER_SCRIPT],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                encoding='utf-8',
+                env=env)
+        except OSError as e:
+            raise TransformError(f"Cannot start node: {e}") from e
+
+        hello = json.loads(self.process.stdout.readline() or '{}')
+        if not hello.get("ready"):
+            self.process.wait()
+            raise TransformError(
+                f"Cannot load prettier: {hello.get('error', 'no answer')}")
+
+        self.pending: Dict[int, Future] = {}
+        self.next_id = 0
+        # Why the worker cannot answer anymore, set once it died.
+        self.error: Optional[str] = None
+        self.lock = threading.Lock()
+        threading.Thread(target=self.read_answers,
+                         name="prettier-worker",
+                         daemon=True).start()
+
+    def read_answers(self):
+        error = "prettier exited."
+        try:
+            for line in self.process.stdout:
+                answer = json.loads(line)
+                with self.lock:
+                    future = self.pending.pop(answer["id"])
+                if "error" in answer:
+                    future.set_exception(TransformError(answer["error"]))
+                else:
+                    future.set_result(answer["output"])
+        except (ValueError, KeyError, TypeError) as e:
+            error = f"Unexpected answer from prettier: {e}"
+            self.process.kill()
+        self.fail(error)
+
+    def fail(self, error: str):
+        """Marks the worker dead and fails every request still waiting."""
+        with self.lock:
+            self.error = self.error or error
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(TransformError(self.error))
+
+    def format(self, source: str, parser: str) -> str:
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                raise TransformError(self.error)
+            self.next_id += 1
+            self.pending[self.next_id] = future
+            try:
+                self.process.stdin.write(
+                    json.dumps({
+                        "id": self.next_id,
+                        "source": source,
+                        "parser": parser
+                    }) + '\n')
+                self.process.stdin.flush()
+            except OSError as e:
+                del self.pending[self.next_id]
+                raise TransformError(f"Cannot write to prettier: {e}") from e
+        return future.result()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+class Transform:
+    """
+    A named body transformation for a set of content types. key identifies
+    the transformation including its options, so cached results are only
+    reused for the same settings.
+    """
+
+    def __init__(self, name: str, content_types: set,
+                 apply: Callable[[bytes, str], bytes], options=None):
+        self.name = name
+        self.content_types = content_types
+        self.apply = apply
+        self.key = name if options is None else f"{name}{json.dumps(options)}"
+
+    def accepts(self, content_type: str) -> bool:
+        return content_type in self.content_types
+
+def prettier_transform() -> Tuple[Transform, Callable[[], None]]:
+    """Returns the transform and a function that stops its worker."""
+    worker, error = None, None
+    lock = threading.Lock()
+
+    def apply(body: bytes, content_type: str) -> bytes:
+        nonlocal worker, error
+        with lock:
+            if error is not None:
+                raise error
+            if worker is None:
+                try:
+                    worker = PrettierWorker()
+                except TransformError as e:
+                    error = e
+                    raise
+        try:
+            source = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return body
+        return worker.format(source, PRETTIER_PARSERS[content_type]).encode()
+
+    def close():
+        if worker is not None:
+            worker.close()
+
+    return Transform("prettier", set(PRETTIER_PARSERS), apply), close
+
+def rewrite_urls_transform(
+        rewrites: List[Tuple[str, str]]) -> Tuple[Transform, None]:
+    """Replaces URL prefixes, e.g. a staging origin with the live one."""
+    encoded = [(old.encode(), new.encode()) for old, new in rewrites]
+
+    def apply(body: bytes, _content_type: str) -> bytes:
+        for old, new in encoded:
+            body = body.replace(old, new)
+        return body
+
+    return Transform("rewrite-urls", TEXT_CONTENT_TYPES, apply,
+                     rewrites), None
+
+TRANSFORMS = {
+    "prettier": lambda options: prettier_transform(),
+    "rewrite-urls": lambda options: rewrite_urls_transform(
+        options.get("rewrite_urls", []))
+}
+
+def register_transform(name: str, factory: Callable[[dict], tuple]):
+    """
+    factory(options) returns (Transform, close function or None). options
+    holds the --process settings, e.g. rewrite_urls.
+    """
+    TRANSFORMS[name] = factory
+
+def load_transform_cache(cache_file: Path) -> Dict[str, str]:
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def transform_body(chain: List[Transform], body: bytes,
+                   content_type: str) -> bytes:
+    for transform in chain:
+        body = transform.apply(body, content_type)
+    return body
+
+def run_transforms(names: List[str],
+                   options: dict,
+                   base_dir: Path,
+                   url_to_folder_map: dict,
+                   processed_index: dict,
+                   body_store: BodyStore,
+                   cache_file: Path,
+                   workers: Optional[int] = None) -> dict:
+    """
+    Applies the named transforms to the processed bodies they accept.
+
+    Each distinct body is transformed once per chain on a thread pool, and
+    results are cached across runs by input digest. Outputs are added to
+    the body store and linked in place of the original, and META and the
+    processed index are updated to the new digest. Recorded streams are
+    left as they are since their chunks describe the original bytes.
+
+    Returns counts of transformed, cached and failed bodies.
+    """
+    transforms, closers = [], []
+    for name in names:
+        transform, close = TRANSFORMS[name](options)
+        transforms.append(transform)
+        if close:
+            closers.append(close)
+
+    cache = load_transform_cache(cache_file)
+    # (chain key, input digest) -> [map keys]
+    batch: Dict[Tuple[str, str], List[str]] = {}
+    chains: Dict[str, Tuple[List[Transform], str]] = {}
+
+    for map_key, entry in processed_index.items():
+        chain = [t for t in transforms if t.accepts(entry["content_type"])]
+        if not chain:
+            continue
+        rel_meta_path, _ = url_to_folder_map[map_key]
+        with open(base_dir / rel_meta_path, 'r', encoding='utf-8') as f:
+            if "chunks" in json.load(f):
+                continue
+        chain_key = '+'.join(t.key for t in chain)
+        chains[chain_key] = (chain, entry["content_type"])
+        batch.setdefault((chain_key, entry["sha256"]), []).append(map_key)
+
+    stats = {"transformed": 0, "cached": 0, "failed": 0}
+    results: Dict[Tuple[str, str], str] = {}
+    to_transform = []
+    for item in batch:
+        cached = cache.get(':'.join(item))
+        if cached and body_store.path(cached).exists():
+            results[item] = cached
+            stats["cached"] += 1
+        else:
+            to_transform.append(item)
+
+    def transform_item(item: Tuple[str, str]) -> bytes:
+        chain_key, digest = item
+        chain, content_type = chains[chain_key]
+        return transform_body(chain, body_store.path(digest).read_bytes(),
+                              content_type)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(item, pool.submit(transform_item, item))
+                       for item in to_transform]
+            for item, future in futures:
+                try:
+                    output = future.result()
+                except TransformError as e:
+                    print(f"Skip transforming {batch[item][0]}: {e}")
+                    stats["failed"] += 1
+                    continue
+                results[item] = body_store.put(output)
+                cache[':'.join(item)] = results[item]
+                stats["transformed"] += 1
+    finally:
+        for close in closers:
+            close()
+
+    for item, output_digest in results.items():
+        for map_key in batch[item]:
+            rel_meta_path, rel_body_path = url_to_folder_map[map_key]
+            body_store.link(output_digest, str(base_dir / rel_body_path))
+            update_body_digest(base_dir / rel_meta_path, output_digest)
+            processed_index[map_key].update(
+                sha256=output_digest,
+                bytes=body_store.path(output_digest).stat().st_size)
+
+    with open(cache_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+
+    return stats
+
+def update_body_digest(meta_path: Path, digest: str):
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    meta["body_sha256"] = digest
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=4)
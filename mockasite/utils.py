@@ -1,10 +1,15 @@
 import os
+import re
 import sys
 import pwd
 import subprocess
 import zlib
+import hashlib
 import time
 import socket
+import json
+from functools import lru_cache
+from urllib.parse import parse_qsl, urlparse
 from typing import Iterable, Tuple, Optional, List
 from pathlib import Path
 
@@ -17,9 +22,42 @@ VOLATILE_QUERY_PARAMS = {
     "msclkid",
 }
 
+# Hosts that are not recorded by default: analytics beacons and ad networks
+# only add bulk to a capture and are not needed to replay the site.
+DEFAULT_CAPTURE_DENY_HOSTS = {
+    "google-analytics.com",
+    "analytics.google.com",
+    "doubleclick.net",
+    "googlesyndication.com",
+    "googleadservices.com",
+    "hotjar.com",
+    "segment.io",
+    "mixpanel.com",
+}
+
+# Content types that are always replayed chunk by chunk when their chunk
+# timing was recorded.
+STREAM_CONTENT_TYPES = {
+    "text/event-stream",
+    "application/x-ndjson",
+    "application/stream+json",
+    "multipart/x-mixed-replace",
+}
+
+# Distinct requests whose map key is kept by get_cached_map_key; the least
+# recently used ones are evicted beyond this.
+MAP_KEY_CACHE_SIZE = 8192
+
+# Written by --process next to url_to_folder_map.json.
+BODY_FINGERPRINT_INDEX_FILE = "body_fingerprints.json"
+
 def get_pkg_name():
     return __package__ if __package__ else "mockasite"
 
+def is_valid_site_name(name: str) -> bool:
+    """Site names become directory names, so no separators or dot dirs."""
+    return re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9._-]*", name) is not None
+
 def is_root() -> bool:
     return os.geteuid() == 0
 
@@ -102,6 +140,15 @@ def re_run_as_sudo():
         sys.exit(e.returncode)
     sys.exit(0)
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def hash_crc32(value: str) -> str:
     return format(zlib.crc32(value.encode()) & 0xffffffff, '08x')
 
@@ -147,6 +194,18 @@ def generate_map_key(http_method: str,
     base_key = f"{http_method}|{path}|{query_param_hash}|{origin_hash}"
     return f"{base_key}|{sequence_number}" if sequence_number is not None else base_key
 
+@lru_cache(maxsize=MAP_KEY_CACHE_SIZE)
+def get_cached_map_key(http_method: str, path: str,
+                       query_params: Tuple[str, ...],
+                       origin_header: str) -> str:
+    """
+    generate_map_key for the request path of playback. Keys are cached per
+    method, path, query parameter names in request order and origin, so a
+    repeated request costs one dict lookup instead of validating, sorting
+    and hashing again.
+    """
+    return generate_map_key(http_method, path, query_params, origin_header)
+
 def split_map_key(map_key: str,
                   delimiter: str = '|') -> Tuple[str, str, str, str]:
     components = map_key.split(delimiter)
@@ -156,6 +215,75 @@ def split_map_key(map_key: str,
 
     return (components[0], components[1], components[2], components[3], None)
 
+def get_base_map_key(map_key: str) -> str:
+    """Returns map_key without its sequence number."""
+    http_method, path, query_param_hash, origin_hash, _ = split_map_key(
+        map_key)
+    return f"{http_method}|{path}|{query_param_hash}|{origin_hash}"
+
+def canonicalize_json(value, ignore_fields: set, path: str = ""):
+    """
+    Drops ignored fields from a decoded JSON value. A field matches by name
+    at any depth, or by its dotted path from the root (e.g. variables.id).
+    """
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            key_path = f"{path}.{key}" if path else str(key)
+            if key in ignore_fields or key_path in ignore_fields:
+                continue
+            result[key] = canonicalize_json(item, ignore_fields, key_path)
+        return result
+    if isinstance(value, list):
+        return [canonicalize_json(item, ignore_fields, path) for item in value]
+    return value
+
+def body_fingerprint(body: bytes, content_type: str,
+                     ignore_fields: Iterable[str] = ()) -> Optional[str]:
+    """
+    Returns a fingerprint of a request body that does not depend on JSON key
+    order or form field order, or None for an empty body. Bodies that are
+    neither JSON nor form encoded are fingerprinted as is.
+    """
+    if not body:
+        return None
+
+    ignore_fields = set(ignore_fields)
+    content_type = (content_type or "").split(';', 1)[0].strip().lower()
+
+    canonical = body
+    if content_type == "application/x-www-form-urlencoded":
+        fields = parse_qsl(body.decode('utf-8', 'replace'),
+                           keep_blank_values=True)
+        canonical = json.dumps(
+            sorted(f for f in fields if f[0] not in ignore_fields)).encode()
+    else:
+        try:
+            value = json.loads(body)
+        except ValueError:
+            pass
+        else:
+            canonical = json.dumps(canonicalize_json(value, ignore_fields),
+                                   sort_keys=True,
+                                   separators=(',', ':')).encode()
+
+    return hashlib.sha256(canonical).hexdigest()[:16]
+
+def get_processed_hosts(url_to_folder_map: dict) -> List[str]:
+    """
+    Returns the host names found in a processed map. Every body path starts
+    with the request netloc, see process_capture.
+    """
+    hosts = set()
+    for value in url_to_folder_map.values():
+        if value is None: continue
+        _, rel_body_path = value
+        netloc = Path(rel_body_path).parts[0]
+        host = urlparse(f"//{netloc}").hostname
+        if host:
+            hosts.add(host)
+    return sorted(hosts)
+
 def get_next_available_map_key(mapKey: str, url_to_folder_map: dict,
                                query_params: Iterable,
                                origin_header: str) -> str:
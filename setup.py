@@ -15,6 +15,8 @@ setup(
     install_requires=[
         'flask',
         'flask-cors',
-        'mitmproxy'
+        'mitmproxy',
+        'zstandard',
+        'brotli'
     ]
 )